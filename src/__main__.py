@@ -0,0 +1,4 @@
+# Entry point of python src
+from cli import main
+
+raise SystemExit(main())
@@ -0,0 +1,65 @@
+import numpy as np
+from utils import interpolate_positions
+
+def occupancy_histograms(store, channel, times, bins=(100, 50), max_positions=10**7):
+    """
+    Number of particles in each cell of a regular grid over the channel at each of the given times.
+    Particles that left the domain are not counted after their exit time. The particles are processed in
+    chunks of at most max_positions interpolated positions, so memory does not grow with the particle count.
+    Returns counts with shape (len(times), nx, ny) and the x and y edges of the grid.
+    """
+    times = np.atleast_1d(np.asarray(times, dtype=float))
+    nx, ny = bins
+    x_edges = np.linspace(channel.vertices[:, 0].min(), channel.vertices[:, 0].max(), nx + 1)
+    y_edges = np.linspace(channel.vertices[:, 1].min(), channel.vertices[:, 1].max(), ny + 1)
+    counts = np.zeros(times.size*nx*ny, dtype=np.int64)
+    frame = np.arange(times.size)[:, None]*nx*ny
+    chunk = max(1, max_positions//times.size)
+    for start in range(0, len(store), chunk):
+        sub = store.slice(start, min(start + chunk, len(store)))
+        positions = interpolate_positions(sub, times)
+        present = np.ones(positions.shape[:2], dtype=bool)
+        if sub.out is not None:
+            present = ~(sub.out[None, :] & (times[:, None] >= sub.total_times()[None, :]))
+        ix = np.clip(np.searchsorted(x_edges, positions[..., 0], side='right') - 1, 0, nx - 1)
+        iy = np.clip(np.searchsorted(y_edges, positions[..., 1], side='right') - 1, 0, ny - 1)
+        counts += np.bincount((frame + ix*ny + iy)[present], minlength=counts.size)
+    return counts.reshape(times.size, nx, ny), x_edges, y_edges
+
+def wall_hit_density(store, channel, bins=50, names=None, max_points=10**6):
+    """
+    Density of wall hits along each wall named in names (by default the rebounding walls, i.e. the cone),
+    in hits per unit length and per particle. Every recorded point but the initial one is a hit.
+    Returns a dict from wall name to (density, edges), edges being distances from the start of the wall.
+    """
+    names = [n for n, k in zip(channel.names, channel.kinds) if k == "rebound"] if names is None else names
+    walls = np.array([channel.names.index(n) for n in names])
+    counts = np.zeros((walls.size, bins), dtype=np.int64)
+    scale = np.abs(channel.vertices).max()
+    is_initial = np.zeros(store.points.shape[0], dtype=bool)
+    is_initial[store.offsets[:-1]] = True
+    for start in range(0, store.points.shape[0], max_points):
+        points = store.points[start:start + max_points][~is_initial[start:start + max_points]]
+        # Position along each wall (s in [0,1]) and distance to its line
+        ox = points[:, None, 0] - channel.start[None, walls, 0]
+        oy = points[:, None, 1] - channel.start[None, walls, 1]
+        s = (ox*channel.tangent[None, walls, 0] + oy*channel.tangent[None, walls, 1])/channel.length[None, walls]
+        dist = np.abs(ox*channel.normal[None, walls, 0] + oy*channel.normal[None, walls, 1])
+        on_wall = (dist < 1e-9*scale) & (s >= 0) & (s <= 1)
+        k = np.clip((s*bins).astype(np.int64), 0, bins - 1)
+        w = np.broadcast_to(np.arange(walls.size)[None, :], on_wall.shape)
+        counts += np.bincount((w*bins + k)[on_wall], minlength=walls.size*bins).reshape(walls.size, bins)
+    result = {}
+    for i, name in enumerate(names):
+        edges = np.linspace(0, channel.length[walls[i]], bins + 1)
+        result[name] = (counts[i]/(len(store)*np.diff(edges)), edges)
+    return result
+
+def outlet_flux(exit_times, bins=100, time_range=None):
+    """
+    Outlet flux time series: number of particles leaving the domain per unit time in each time bin.
+    Only needs the exit times, so it works with any recording level.
+    Returns the flux and the time edges of the bins.
+    """
+    counts, edges = np.histogram(np.asarray(exit_times), bins=bins, range=time_range)
+    return counts/np.diff(edges), edges
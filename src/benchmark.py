@@ -0,0 +1,149 @@
+"""
+Benchmarks of the simulation hot path. Measures particles per second and peak memory across particle counts,
+Channel geometries, engines and trajectory recording levels, plus the interpolation used by the visualizations.
+
+    python src/benchmark.py --output baseline.json
+    python src/benchmark.py --compare baseline.json --threshold 0.2
+
+A comparison fails (exit status 1) when a case is slower or uses more memory than the baseline by more than
+the threshold (a fraction).
+"""
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+import numpy as np
+from channel import Channel
+from problem import Problem
+from trajectory import RECORD_LEVELS
+
+# Benchmarked geometries as (l, L, d, D)
+GEOMETRIES = {
+    "default": (0.7, 1, 0.15, 0.5), # Geometry of main.py
+    "narrow": (0.7, 1, 0.05, 0.5), # Narrow outlet, more rebounds per particle
+    "long_cone": (0.2, 1, 0.15, 0.5), # Cone starting close to the inlet
+}
+
+def measure(fn, repeat):
+    """
+    Best wall time of repeat calls of fn and peak traced memory of one extra call (in bytes).
+    """
+    seconds = min(_timed(fn) for _ in range(repeat))
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+def _timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+def simulation_case(geometry, n_particles, engine, record, seed=0):
+    # Full simulation of a Problem, from the initial distribution to the end of the run
+    channel = Channel(*GEOMETRIES[geometry])
+    def run():
+        problem = Problem(channel, n_particles, 1.0, 0.0, engine=engine, rng=np.random.default_rng(seed),
+                          record=record)
+        problem.distribute_initial_particles()
+        problem.run_simulation(verbose=False)
+    return run
+
+def interpolation_cases(n_particles, seed=0, n_frames=200):
+    # Interpolation of recorded trajectories: per particle (scalar path) and over a TrajectoryStore
+    from utils import interpolate_trayectory, interpolate_positions
+    problem = Problem(Channel(*GEOMETRIES["default"]), n_particles, 1.0, 0.0, rng=np.random.default_rng(seed))
+    problem.distribute_initial_particles()
+    problem.run_simulation(verbose=False)
+    store = problem.trajectories()
+    times = np.linspace(0, np.max(store.total_times()), n_frames)
+    def per_particle():
+        for particle in problem.particles:
+            interpolate_trayectory(particle)
+    def vectorized():
+        interpolate_positions(store, times)
+    return {"interpolate_trayectory": per_particle, "interpolate_positions": vectorized}
+
+def run_suite(counts=(1000, 10000), engines=("scalar", "batch"), records=RECORD_LEVELS, geometries=tuple(GEOMETRIES),
+              repeat=3, interpolation_particles=1000, verbose=True):
+    """
+    Run every benchmark case and return a dict from case name to its timings.
+    """
+    results = {}
+    def add(name, fn, n_particles):
+        seconds, peak = measure(fn, repeat)
+        results[name] = {"particles": n_particles, "seconds": seconds, "particles_per_second": n_particles/seconds,
+                         "peak_memory_mb": peak/2**20}
+        if verbose:
+            print("{:<45} {:>12.0f} particles/s {:>10.2f} MB".format(name, n_particles/seconds, peak/2**20))
+
+    for geometry in geometries:
+        for engine in engines:
+            for record in records:
+                for n in counts:
+                    name = "simulate/{}/{}/{}/{}".format(geometry, engine, record, n)
+                    add(name, simulation_case(geometry, n, engine, record), n)
+    if interpolation_particles:
+        for name, fn in interpolation_cases(interpolation_particles).items():
+            add("interpolate/{}/{}".format(name, interpolation_particles), fn, interpolation_particles)
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    Cases of results slower or heavier than the baseline by more than the threshold (a fraction).
+    Returns a list of messages, empty if there is no regression.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        reference = baseline[name]
+        speed = result["particles_per_second"]/reference["particles_per_second"]
+        memory = result["peak_memory_mb"]/max(reference["peak_memory_mb"], 1e-9)
+        if speed < 1 - threshold:
+            regressions.append("{}: {:.0%} of the baseline speed".format(name, speed))
+        if memory > 1 + threshold:
+            regressions.append("{}: {:.0%} of the baseline peak memory".format(name, memory))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the particle simulation")
+    parser.add_argument("--counts", type=int, nargs="+", default=[1000, 10000], help="Particle counts")
+    parser.add_argument("--engines", nargs="+", default=["scalar", "batch"], help="Simulation engines")
+    parser.add_argument("--records", nargs="+", default=list(RECORD_LEVELS), choices=RECORD_LEVELS,
+                        help="Trajectory recording levels")
+    parser.add_argument("--geometries", nargs="+", default=list(GEOMETRIES), choices=list(GEOMETRIES),
+                        help="Channel geometries")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed repetitions of each case (the best is kept)")
+    parser.add_argument("--interpolation-particles", type=int, default=1000,
+                        help="Particles of the interpolation benchmarks (0 to skip them)")
+    parser.add_argument("--output", help="Write the results to this JSON baseline")
+    parser.add_argument("--compare", help="Compare the results against this JSON baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Allowed slowdown or memory growth over the baseline (fraction)")
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.counts, args.engines, args.records, args.geometries, args.repeat,
+                        args.interpolation_particles)
+    if args.output:
+        meta = {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+                "date": time.strftime("%Y-%m-%d %H:%M:%S")}
+        with open(args.output, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for message in regressions:
+            print("REGRESSION " + message)
+        if regressions:
+            return 1
+        print("No regression over {} (threshold {:.0%})".format(args.compare, args.threshold))
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
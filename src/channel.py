@@ -1,35 +1,29 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from utils import figure_features
+from geometry import Geometry, OUTLET, REBOUND, ABSORB
 
-class Channel:
-    def __init__(self, l, L, d, D):
+# What the low and up planes do with the particles reaching them
+GLUE = "glue" # They get glued, as in the original model
+REFLECT = "reflect" # They rebound diffusely, particles only leave through the outlet or back through the inlet
+
+class Channel(Geometry):
+    def __init__(self, l, L, d, D, planes=GLUE):
         self.l = l # Starting of the conical section
         self.L = L # Length of the channel
         self.d = d # Diameter of the outlet
         self.D = D # Diameter of te channel
         self.alpha = np.arctan((D-d)/2/(L-l)) # Opening angle of the conical section (needed to compute absolute angles)
-            
-    def visualize(self, visualize=False):
-        # For LaTeX labels rendering
-        figure_features()
-        
-        # Figure
-        fig, ax = plt.subplots()
-        ax.plot([0, self.l], [0, 0], color='k', linewidth=2)
-        ax.plot([self.l, self.L], [0, (self.D-self.d)/2], color='k', linewidth=2)
-        ax.plot([self.L, self.L], [(self.D-self.d)/2, (self.D+self.d)/2], color='k', linewidth=2)
-        ax.plot([self.L, self.l], [(self.D+self.d)/2, self.D], color='k', linewidth=2)
-        ax.plot([self.l, 0], [self.D, self.D], color='k', linewidth=2)
-        ax.plot([0, 0], [self.D, 0], color='k', linewidth=2)
-
-        # Labels
-        plt.xlabel(r'$x$')
-        plt.ylabel(r'$y$')
-        
-        # If a quick visualization is needed
-        if visualize:
-            plt.show()
-        # To make the figure available for further animation
-        else:
-            return fig, ax
\ No newline at end of file
+        # Constants derived from the parameters, used by the rebound conditions
+        self.y_low = (D-d)/2 # Lower corner of the outlet
+        self.y_up = (D+d)/2 # Upper corner of the outlet
+        self.c = np.sqrt((L-l)**2 + ((D-d)/2)**2) # Side length of the conic section
+        self.m_low = (D-d)/(2*(L-l)) # Slope of the lower conic wall
+        self.b_low = -self.m_low*l # y-intercept of the lower conic wall
+        self.m_up = (d-D)/(2*(L-l)) # Slope of the upper conic wall
+        self.b_up = -self.m_up*l + D # y-intercept of the upper conic wall
+        self.planes = planes # "glue" or "reflect"
+        # The channel is a polygon whose inlet glues the particles and whose conic walls rebound them; the planes
+        # glue them too unless planes is "reflect" (full multi-bounce mode, only for the ray casting engines)
+        plane = REBOUND if planes == REFLECT else ABSORB
+        super().__init__([(0, 0), (l, 0), (L, self.y_low), (L, self.y_up), (l, D), (0, D)],
+                         [plane, REBOUND, OUTLET, REBOUND, plane, ABSORB],
+                         ["low_plane", "cone_low", "outlet", "cone_up", "up_plane", "inlet"])
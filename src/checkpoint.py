@@ -0,0 +1,137 @@
+import json
+import os
+import time
+import numpy as np
+from particles import Particle
+from trajectory import FULL, ENDPOINTS, TrajectoryStore
+
+# Per-particle arrays of the batch engines saved in the checkpoints
+ENGINE_ARRAYS = ("x", "y", "Vx", "Vy", "time", "out", "bounces", "capped", "x0", "y0")
+
+def rng_state(rng):
+    """
+    State of a np.random.Generator (or of the global np.random state) as a JSON string.
+    """
+    state = rng.get_state(legacy=False) if rng is np.random else rng.bit_generator.state
+    return json.dumps(state, default=lambda a: a.tolist())
+
+def set_rng_state(rng, text):
+    state = json.loads(text)
+    if isinstance(state.get("state"), dict) and "key" in state["state"]:
+        state["state"]["key"] = np.array(state["state"]["key"], dtype=np.uint32) # Mersenne Twister key
+    if rng is np.random:
+        np.random.set_state(state)
+    else:
+        rng.bit_generator.state = state
+
+def save_checkpoint(path, meta, arrays):
+    """
+    Write the arrays and the JSON metadata to path (a .npz file). The file is written next to its destination
+    and then renamed, so an interruption while writing never leaves a broken checkpoint.
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+    os.replace(tmp, path)
+
+def load_checkpoint(path):
+    """
+    Metadata dict and dict of arrays saved by save_checkpoint.
+    """
+    with np.load(path) as data:
+        arrays = {k: data[k] for k in data.files if k != "meta"}
+        meta = json.loads(str(data["meta"]))
+    return meta, arrays
+
+def problem_config(problem):
+    """
+    Arguments of problem that its run depends on. They are saved with the checkpoints and must match on resume.
+    """
+    channel = problem.channel
+    return {"n_particles": problem.n_particles, "engine": problem.engine, "record": problem.record,
+            "vertices": channel.vertices.tolist(), "kinds": list(channel.kinds), "Vx": float(problem.Vx),
+            "Vy": float(problem.Vy), "tol": float(problem.tol), "kernel": repr(problem.kernel),
+            "sampling": problem.sampling, "max_bounces": problem.max_bounces}
+
+def problem_state(problem, position):
+    """
+    Metadata and arrays with everything needed to continue the run of problem: the random generator and
+    kernel states, the count and the particles. position is the index of the next particle to simulate with the
+    scalar engine, or the array of active particles with the batch engines.
+    """
+    kernel = problem.kernel
+    meta = dict(problem_config(problem), count=problem.count, rng=rng_state(problem.rng), kernel_pos=kernel.pos,
+                kernel_key=kernel.key, time=time.time())
+    arrays = {"kernel_buffer": kernel.buffer}
+    if problem.batch is None:
+        meta["next"] = int(position)
+        done, pending = problem.particles[:position], problem.particles[position:]
+        arrays.update(pending_y=np.array([p.y for p in pending], dtype=float),
+                      x=np.array([p.x for p in done], dtype=float), y=np.array([p.y for p in done], dtype=float),
+                      Vx=np.array([p.Vx for p in done], dtype=float), Vy=np.array([p.Vy for p in done], dtype=float),
+                      total_time=np.array([p.total_time for p in done], dtype=float),
+                      out=np.array([p.out for p in done], dtype=bool),
+                      bounces=np.array([p.bounces for p in done], dtype=np.int64))
+        if problem.record in (FULL, ENDPOINTS):
+            store = TrajectoryStore.from_particles(done)
+            arrays.update(points=store.points, velocities=store.velocities, dt=store.dt, offsets=store.offsets)
+        return meta, arrays
+
+    engine = problem.batch
+    arrays["active"] = np.asarray(position)
+    arrays.update({name: getattr(engine, name) for name in ENGINE_ARRAYS if getattr(engine, name) is not None})
+    if hasattr(engine, "wall"):
+        arrays["wall"] = engine.wall
+    if engine.log:
+        for k, name in enumerate(("log_ids", "log_x", "log_y", "log_Vx", "log_Vy", "log_dt")):
+            arrays[name] = np.concatenate([np.broadcast_to(chunk[k], chunk[0].shape) for chunk in engine.log])
+    return meta, arrays
+
+def restore_problem(problem, meta, arrays):
+    """
+    Put problem back in the state saved by problem_state and return the position to continue from.
+    problem must have been created with the same arguments as the one that was saved.
+    """
+    for key, value in problem_config(problem).items():
+        if meta.get(key) != value:
+            raise ValueError("The checkpoint was saved with {} = {}, not {}".format(key, meta.get(key), value))
+    set_rng_state(problem.rng, meta["rng"])
+    problem.kernel.buffer = arrays["kernel_buffer"]
+    problem.kernel.pos = meta["kernel_pos"]
+    problem.kernel.key = meta["kernel_key"]
+    problem.count = meta["count"]
+
+    if problem.engine == "scalar":
+        n_done = meta["next"]
+        particles = []
+        s = np.arange(n_done + 1) if "offsets" not in arrays else arrays["offsets"] - np.arange(n_done + 1)
+        for i in range(n_done):
+            p = Particle(0, 0.0, problem.Vx, problem.Vy, problem.record, i)
+            p.x, p.y = arrays["x"][i].item(), arrays["y"][i].item()
+            p.Vx, p.Vy = arrays["Vx"][i].item(), arrays["Vy"][i].item()
+            p.total_time = arrays["total_time"][i].item()
+            p.out = bool(arrays["out"][i])
+            p.bounces = int(arrays["bounces"][i])
+            if "offsets" in arrays:
+                o = arrays["offsets"]
+                p.trayectory = [tuple(point) for point in arrays["points"][o[i]:o[i + 1]].tolist()]
+                p.velocities = [tuple(v) for v in arrays["velocities"][s[i]:s[i + 1]].tolist()]
+                p.time = arrays["dt"][s[i]:s[i + 1]].tolist()
+            particles.append(p)
+        for i, y in enumerate(arrays["pending_y"].tolist()):
+            particles.append(Particle(0, y, problem.Vx, problem.Vy, problem.record, n_done + i))
+        problem.particles = particles
+        return n_done
+
+    problem.place_particles(arrays["y0"] if "y0" in arrays else arrays["y"])
+    engine = problem.batch
+    for name in ENGINE_ARRAYS:
+        if name in arrays:
+            setattr(engine, name, arrays[name].copy())
+    if "wall" in arrays:
+        engine.wall = arrays["wall"].copy()
+        engine.n_capped = int(np.count_nonzero(engine.capped))
+    engine.log = []
+    if "log_ids" in arrays:
+        engine.log.append(tuple(arrays[name] for name in ("log_ids", "log_x", "log_y", "log_Vx", "log_Vy", "log_dt")))
+    return arrays["active"]
@@ -0,0 +1,168 @@
+"""
+Headless command-line runs of the simulation. A run is described by a JSON (or TOML) config file and/or
+command-line arguments, which take precedence over the file:
+
+    python src --config run.json
+    python src --l 0.7 --L 1 --d 0.15 --D 0.5 --particles 1000000 --seed 1 --summary summary.json
+
+Config keys: geometry {l, L, d, D}, particles, Vx, Vy, seed, engine, kernel ("cosine", "specular" or
+"maxwell"), accommodation, sampling, workers, chunk_size, tol and outputs {summary, exit_times, animation}.
+matplotlib is only imported when an animation is requested.
+"""
+import argparse
+import json
+import os
+import numpy as np
+
+DEFAULTS = {
+    "geometry": {"l": 0.7, "L": 1, "d": 0.15, "D": 0.5}, # Geometry of main.py
+    "particles": 500,
+    "Vx": 0.1,
+    "Vy": 0.0,
+    "seed": None,
+    "engine": "batch",
+    "kernel": "cosine",
+    "accommodation": 1.0,
+    "sampling": "uniform",
+    "workers": 1,
+    "chunk_size": 100000,
+    "tol": 0.01,
+    "outputs": {"summary": None, "exit_times": None, "animation": None},
+}
+
+def load_config(path):
+    """
+    Read a run config from a JSON or TOML (.toml) file.
+    """
+    if path.endswith(".toml"):
+        import tomllib
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+def merge_config(config, args):
+    """
+    Defaults updated with the config file and then with the command-line arguments that were given.
+    """
+    run = {k: (dict(v) if isinstance(v, dict) else v) for k, v in DEFAULTS.items()}
+    for key, value in config.items():
+        if isinstance(value, dict):
+            run[key].update(value)
+        else:
+            run[key] = value
+    for key in ("l", "L", "d", "D"):
+        if getattr(args, key) is not None:
+            run["geometry"][key] = getattr(args, key)
+    for key in ("summary", "exit_times", "animation"):
+        if getattr(args, key) is not None:
+            run["outputs"][key] = getattr(args, key)
+    for key in ("particles", "Vx", "Vy", "seed", "engine", "kernel", "accommodation", "sampling", "workers",
+                "chunk_size", "tol"):
+        if getattr(args, key) is not None:
+            run[key] = getattr(args, key)
+    return run
+
+def make_kernel(run):
+    from diffuse import CosineKernel, SpecularKernel, MaxwellKernel
+    kernels = {"cosine": CosineKernel, "specular": SpecularKernel}
+    if run["kernel"] == "maxwell":
+        return MaxwellKernel(run["accommodation"])
+    if run["kernel"] not in kernels:
+        raise ValueError("Unknown kernel {}, use cosine, specular or maxwell".format(run["kernel"]))
+    return kernels[run["kernel"]]()
+
+def summarize(run, exit_times, entropy, chunk_sizes=None, chunk_counts=None):
+    """
+    Run description with the seed entropy, the count and the flow rate metrics of the exit times.
+    chunk_sizes and chunk_counts split the exit times in the chunks they were simulated in (a single chunk if None),
+    which the standard error needs with variance-reduced sampling (the spread of the chunks is used then).
+    """
+    from estimator import FlowRateEstimator, needs_replicates
+    estimator = FlowRateEstimator(replicated=needs_replicates(run["sampling"], make_kernel(run)))
+    if chunk_sizes is None:
+        chunk_sizes, chunk_counts = [run["particles"]], [len(exit_times)]
+    offsets = np.concatenate(([0], np.cumsum(chunk_counts)))
+    for i, size in enumerate(chunk_sizes):
+        estimator.update(exit_times[offsets[i]:offsets[i + 1]], int(size))
+    summary = dict(run, entropy=str(entropy), count=estimator.count)
+    se = estimator.standard_error()
+    if estimator.count > 1:
+        summary.update(transmission_probability=estimator.transmission_probability(),
+                       mean_exit_time=estimator.mean, flow_rate=estimator.flow_rate(),
+                       flow_rate_standard_error=float(se) if np.isfinite(se) else None, # None: a single chunk
+                       flow_rate_interarrival=estimator.compute_particles_flow_rate_interarrival(),
+                       flow_rate_max_time=estimator.compute_particles_flow_max_time())
+    return summary
+
+def execute(run):
+    """
+    Run the simulation described by run and write its outputs. Returns the summary dict.
+    An animation needs the full trajectories, so it runs a single Problem; otherwise only exit times are
+    recorded and the particles are split in chunks over run["workers"] processes.
+    """
+    from channel import Channel
+    g = run["geometry"]
+    channel = Channel(g["l"], g["L"], g["d"], g["D"])
+    kernel = make_kernel(run)
+    outputs = run["outputs"]
+    seed_seq = np.random.SeedSequence(run["seed"])
+
+    if outputs.get("animation"):
+        from problem import Problem
+        problem = Problem(channel, run["particles"], run["Vx"], run["Vy"], tol=run["tol"], engine=run["engine"],
+                          rng=np.random.default_rng(seed_seq), kernel=kernel, sampling=run["sampling"])
+        problem.distribute_initial_particles()
+        problem.run_simulation(verbose=False)
+        exit_times = problem.exit_times()
+        chunks = (None, None)
+        from plotting import export_simulation
+        export_simulation(channel, problem.trajectories(), outputs["animation"])
+    else:
+        from ensemble import run_ensemble
+        result = run_ensemble(channel, run["particles"], run["Vx"], run["Vy"], seed=seed_seq.entropy,
+                              n_workers=run["workers"], chunk_size=run["chunk_size"], tol=run["tol"],
+                              engine=run["engine"], kernel=kernel, sampling=run["sampling"])
+        exit_times = result.exit_times
+        chunks = (result.chunk_sizes, result.chunk_counts)
+
+    summary = summarize(run, exit_times, seed_seq.entropy, *chunks)
+    if outputs.get("exit_times"):
+        np.save(outputs["exit_times"], exit_times)
+    if outputs.get("summary"):
+        with open(outputs["summary"], "w") as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Headless diffuse particle rebound simulation")
+    parser.add_argument("--config", help="JSON or TOML run config")
+    for key in ("l", "L", "d", "D"):
+        parser.add_argument("--" + key, type=float, help="Geometry parameter " + key)
+    parser.add_argument("--particles", type=int, help="Number of particles")
+    parser.add_argument("--Vx", type=float, help="Initial x-velocity")
+    parser.add_argument("--Vy", type=float, help="Initial y-velocity")
+    parser.add_argument("--seed", type=int, help="Root seed (random if not given, its entropy is reported)")
+    parser.add_argument("--engine", choices=["scalar", "batch", "geometry", "event"], help="Simulation engine")
+    parser.add_argument("--kernel", choices=["cosine", "specular", "maxwell"], help="Rebound law")
+    parser.add_argument("--accommodation", type=float, help="Accommodation of the maxwell kernel")
+    parser.add_argument("--sampling", choices=["uniform", "stratified", "sobol"], help="Initial height sampling")
+    parser.add_argument("--workers", type=int, help="Worker processes (0 for one per CPU)")
+    parser.add_argument("--chunk-size", dest="chunk_size", type=int, help="Particles per chunk")
+    parser.add_argument("--tol", type=float, help="Distance of the initial heights to the walls")
+    parser.add_argument("--summary", help="Write the summary to this JSON file")
+    parser.add_argument("--exit-times", dest="exit_times", help="Write the exit times to this .npy file")
+    parser.add_argument("--animation", help="Render the animation to this GIF or MP4 file")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    run = merge_config(load_config(args.config) if args.config else {}, args)
+    if run["workers"] == 0:
+        run["workers"] = os.cpu_count()
+    summary = execute(run)
+    for key in ("count", "transmission_probability", "mean_exit_time", "flow_rate", "flow_rate_standard_error",
+                "flow_rate_interarrival", "flow_rate_max_time"):
+        if key in summary:
+            print("{}: {}".format(key, summary[key]))
+    return 0
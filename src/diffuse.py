@@ -1,8 +1,111 @@
+import copy
 import numpy as np
+from sampling import hashed_uniforms
 # Diffuse model based on Knusden cosine law. This model can be changed as desired by the user.
 class Diffuse:
     @staticmethod
-    def sample_angle():
+    def sample_angle(size=None, rng=np.random):
         # Inverse transform sampling: u in [0,1] gives alpha = arcsin(2u - 1)
-        u = np.random.rand()
-        return np.arcsin(2*u - 1) # Return a value between -pi/2 and pi/2
\ No newline at end of file
+        u = rng.random(size) # A float when size is None, an array of angles otherwise
+        return np.arcsin(2*u - 1) # Return a value between -pi/2 and pi/2
+
+# Scattering kernels. All of them return rebound angles measured from the wall normal, between -pi/2 and pi/2,
+# with the same sign convention as Particle.update_velocity_after_rebound.
+class Kernel:
+    needs_incidence = False # True if the kernel uses the specular angle of the incoming particle
+
+    def __init__(self, rng=None, buffer_size=65536, antithetic=False, crn=False):
+        self.rng = rng # Random generator (np.random.Generator), the global np.random state if None
+        self.buffer_size = buffer_size # Number of uniform numbers drawn at once
+        self.buffer = np.empty(0) # Pre-filled uniform numbers
+        self.pos = 0 # Next unused position of the buffer
+        self.antithetic = antithetic # Give particles 2k and 2k+1 antithetic numbers u, 1-u at every rebound
+        self.crn = crn # Key the numbers by particle and rebound number (common random numbers across geometries)
+        self.key = None # Key of the counter-based numbers, drawn from rng on first use
+
+    def with_rng(self, rng):
+        """
+        Copy of the kernel (same parameters) drawing from another random generator.
+        """
+        kernel = copy.copy(self)
+        kernel.rng = rng
+        kernel.buffer = np.empty(0)
+        kernel.pos = 0
+        kernel.key = None
+        return kernel
+
+    def uniforms(self, n, ids=None, steps=None, stream=0):
+        """
+        Return n uniform numbers in [0,1) taken from the buffer, refilling it when it is exhausted.
+        With common random numbers the numbers are instead a function of the particle ids, their rebound
+        number (steps) and the stream, so the same particle gets the same numbers in every geometry.
+        Antithetic numbers are keyed the same way, with particles 2k and 2k+1 getting u and 1-u at the same
+        rebound number and stream: pairing consecutive draws instead would pair the rebounds of one particle.
+        """
+        rng = np.random if self.rng is None else self.rng
+        if self.antithetic and ids is None:
+            raise ValueError("Antithetic numbers are paired by particle, pass the particle ids and rebound numbers")
+        if self.keyed and ids is not None:
+            if self.key is None:
+                self.key = int(rng.random()*2**63)
+            if self.antithetic:
+                u = hashed_uniforms(self.key, ids - (ids & 1), steps, stream)
+                return np.where(ids & 1, 1 - u, u)
+            return hashed_uniforms(self.key, ids, steps, stream)
+        if self.pos + n > self.buffer.size:
+            rest = self.buffer[self.pos:]
+            size = max(self.buffer_size, n - rest.size)
+            self.buffer = rng.random(size)
+            self.pos = n - rest.size
+            return np.concatenate((rest, self.buffer[:self.pos]))
+        u = self.buffer[self.pos:self.pos + n]
+        self.pos += n
+        return u
+
+    @property
+    def keyed(self):
+        # True if the numbers are a function of the particle ids and rebound numbers
+        return self.crn or self.antithetic
+
+    def sample(self, n, theta_in=None, ids=None, steps=None):
+        """
+        Return n rebound angles. theta_in are the specular rebound angles of the incoming particles,
+        ids and steps the particle ids and rebound numbers (only used with common random or antithetic numbers).
+        """
+        raise NotImplementedError
+
+    def options(self):
+        # Non default sampling options, part of the kernel description
+        names = [name for name in ("antithetic", "crn") if getattr(self, name)]
+        return ["{}=True".format(name) for name in names]
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(self.options()))
+
+class CosineKernel(Kernel):
+    def sample(self, n, theta_in=None, ids=None, steps=None):
+        # Knudsen cosine law by inverse transform sampling
+        return np.arcsin(2*self.uniforms(n, ids, steps) - 1)
+
+class SpecularKernel(Kernel):
+    needs_incidence = True
+
+    def sample(self, n, theta_in=None, ids=None, steps=None):
+        # Mirror reflection, no random numbers needed
+        return np.full(n, theta_in, dtype=float)
+
+class MaxwellKernel(Kernel):
+    needs_incidence = True
+
+    def __init__(self, accommodation=1.0, rng=None, buffer_size=65536, antithetic=False, crn=False):
+        super().__init__(rng, buffer_size, antithetic, crn)
+        self.accommodation = accommodation # Fraction of diffuse rebounds (1: cosine law, 0: specular)
+
+    def sample(self, n, theta_in=None, ids=None, steps=None):
+        # Diffuse rebound with probability accommodation, specular rebound otherwise. The choice and the angle
+        # come from different streams, so with antithetic numbers they are paired across particles, not together
+        diffuse = self.uniforms(n, ids, steps, stream=0) < self.accommodation
+        return np.where(diffuse, np.arcsin(2*self.uniforms(n, ids, steps, stream=1) - 1), theta_in)
+
+    def __repr__(self):
+        return "MaxwellKernel({})".format(", ".join(["accommodation={}".format(self.accommodation)] + self.options()))
@@ -0,0 +1,413 @@
+import heapq
+import numpy as np
+from diffuse import CosineKernel
+from trajectory import FULL, ENDPOINTS, TrajectoryStore
+from instrument import DIRECT_EXIT, EXIT, CONIC_REBOUND, LOW_PLANE, UP_PLANE, INLET
+
+class BatchEngine:
+    def __init__(self, channel, x, y, Vx, Vy, kernel=None, record=FULL):
+        """
+        Structure-of-arrays version of the particle simulation. Every particle state is stored in NumPy arrays
+        and the rebound branches of Problem.simulate_particle are applied to all the active particles at once.
+        """
+        self.channel = channel # Channel object
+        self.x = np.array(x, dtype=float) # x-coordinate of the particles
+        self.y = np.array(y, dtype=float) # y-coordinate of the particles
+        self.Vx = np.array(Vx, dtype=float) # x-component of the velocity of the particles
+        self.Vy = np.array(Vy, dtype=float) # y-component of the velocity of the particles
+        self.time = np.zeros(self.x.size) # Accumulated time of flight of each particle
+        self.out = np.zeros(self.x.size, dtype=bool) # Boolean mask of the particles that left the domain
+        self.bounces = np.zeros(self.x.size, dtype=np.int64) # Number of rebounds of each particle
+        self.capped = np.zeros(self.x.size, dtype=bool) # Particles stopped by the bounce cap
+        self.kernel = CosineKernel() if kernel is None else kernel # Scattering kernel
+        self.record = record # Recording level of the trajectories: "full", "endpoints" or "exit_time"
+        self.x0 = self.x.copy() if record in (FULL, ENDPOINTS) else None # Initial positions
+        self.y0 = self.y.copy() if record in (FULL, ENDPOINTS) else None
+        self.log = [] # Chunks of (ids, x, y, Vx, Vy, dt) of every position update when the full path is recorded
+        self.instrumentation = None # Instrumentation object, set by Problem
+
+    def upper_mask(self, idx):
+        # Particles of idx placed in the upper part of the conic section
+        channel = self.channel
+        return (channel.y_up < self.y[idx]) & (self.y[idx] < channel.D)
+
+    def lower_mask(self, idx):
+        # Particles of idx placed in the lower part of the conic section
+        channel = self.channel
+        return (1e-16 < self.y[idx]) & (self.y[idx] < channel.y_low)
+
+    def update_velocity_after_rebound(self, idx, theta):
+        channel = self.channel
+        theta_abs = np.where(self.upper_mask(idx), 3*np.pi/2 - channel.alpha + theta, np.pi/2 + channel.alpha - theta)
+        V = np.sqrt(self.Vx[idx]**2 + self.Vy[idx]**2)
+        self.Vx[idx] = V*np.cos(theta_abs)
+        self.Vy[idx] = V*np.sin(theta_abs)
+
+    def specular_angle(self, idx):
+        # Rebound angles (from the wall normal) that mirror the incoming velocities
+        channel = self.channel
+        upper = self.upper_mask(idx)
+        back = np.arctan2(-self.Vy[idx], -self.Vx[idx])
+        theta = np.where(upper, 3*np.pi/2 - channel.alpha - back, back - np.pi/2 - channel.alpha)
+        return (theta + np.pi) % (2*np.pi) - np.pi
+
+    def sample_angle(self, idx):
+        # Rebound angles of the particles of idx drawn from the scattering kernel
+        theta_in = self.specular_angle(idx) if self.kernel.needs_incidence else None
+        theta = self.kernel.sample(idx.size, theta_in, idx, self.bounces[idx])
+        self.bounces[idx] += 1
+        return theta
+
+    def update_position(self, idx, dt):
+        self.x[idx] += self.Vx[idx]*dt
+        self.y[idx] += self.Vy[idx]*dt
+        self.time[idx] += dt
+        if self.record == FULL and idx.size > 0:
+            self.log.append((idx, self.x[idx], self.y[idx], self.Vx[idx], self.Vy[idx], np.broadcast_to(dt, idx.shape)))
+
+    def trajectories(self):
+        """
+        TrajectoryStore with the recorded trajectories, None if only the exit times are recorded.
+        """
+        n = self.x.size
+        ids = np.arange(n)
+        if self.record == ENDPOINTS:
+            points = np.column_stack((np.stack((self.x0, self.x), axis=1).ravel(), np.stack((self.y0, self.y), axis=1).ravel()))
+            return TrajectoryStore(points, np.column_stack((self.Vx, self.Vy)), self.time.copy(), 2*np.arange(n + 1),
+                                   self.out.copy())
+        if self.record != FULL:
+            return None
+        seg_ids = np.concatenate([chunk[0] for chunk in self.log]) if self.log else np.empty(0, dtype=np.int64)
+        logged = [np.concatenate([chunk[k] for chunk in self.log]) if self.log else np.empty(0) for k in range(1, 6)]
+        points = np.column_stack((np.concatenate((self.x0, logged[0])), np.concatenate((self.y0, logged[1]))))
+        return TrajectoryStore.from_segments(n, np.concatenate((ids, seg_ids)), points, seg_ids,
+                                             np.column_stack((logged[2], logged[3])), logged[4], self.out.copy())
+
+    def distance_to_conic_section_x(self, idx):
+        channel = self.channel
+        y = self.y[idx]
+        d1 = np.full(y.size, float(channel.L)) # Not in the conic section automatically left the channel
+        upper = self.upper_mask(idx)
+        lower = self.lower_mask(idx)
+        d1[upper] = channel.l + (y[upper] - channel.D)/channel.m_up
+        d1[lower] = channel.l + y[lower]/channel.m_low
+        return d1
+
+    def check_output_condition(self, idx, theta):
+        channel = self.channel
+        x, y = self.x[idx], self.y[idx]
+        upper = self.upper_mask(idx)
+        y_near = np.where(upper, channel.y_up, channel.y_low) # Closest outlet corner
+        y_far = np.where(upper, channel.y_low, channel.y_up) # Farthest outlet corner
+        a = np.sqrt((channel.L-x)**2 + (y_near-y)**2)
+        b = np.sqrt((channel.L-x)**2 + (y_far-y)**2)
+        gamma = np.acos((a**2 + b**2 - channel.d**2)/(2*a*b))
+        return theta > (np.pi/2 - gamma), gamma
+
+    def check_output_time(self, idx):
+        return (self.channel.L - self.x[idx])/self.Vx[idx]
+
+    def check_rebound_condition_conic_section(self, idx, theta, gamma):
+        channel = self.channel
+        x, y = self.x[idx], self.y[idx]
+        upper = self.upper_mask(idx)
+        a = np.where(upper, np.sqrt((channel.l-x)**2 + y**2), np.sqrt((channel.l-x)**2 + (y-channel.D)**2))
+        b = np.where(upper, np.sqrt((channel.L-x)**2 + (channel.y_low-y)**2),
+                     np.sqrt((channel.L-x)**2 + (channel.y_up-y)**2))
+        c = channel.c # Side length of the conic section
+        xi = np.acos((a**2 + b**2 - c**2)/(2*a*b))
+        return ((np.pi/2 - gamma - xi) < theta) & (theta < (np.pi/2 - gamma))
+
+    def check_rebound_time_conic_section(self, idx):
+        channel = self.channel
+        upper = self.upper_mask(idx)
+        # Slope and y-intercept of the opposite conic wall
+        m = np.where(upper, channel.m_low, channel.m_up)
+        b = np.where(upper, channel.b_low, channel.b_up)
+        return (self.y[idx] - m*self.x[idx] - b)/(m*self.Vx[idx] - self.Vy[idx])
+
+    def check_rebound_condition_low_plane(self, idx, theta):
+        channel = self.channel
+        x, y = self.x[idx], self.y[idx]
+        lower = self.lower_mask(idx)
+        # Lower part of the conic section
+        absolute_theta = np.pi/2 + channel.alpha - theta
+        a = np.sqrt(x**2 + y**2)
+        b = np.sqrt((channel.l-x)**2 + y**2)
+        xi = np.acos((a**2 + b**2 - channel.l**2)/(2*a*b))
+        low = (np.pi + channel.alpha - xi < absolute_theta) & (absolute_theta < np.pi + channel.alpha)
+        # Upper part of the conic section
+        absolute_theta = 3*np.pi/2 - channel.alpha + theta
+        Gamma = xi # Same triangle as in the lower part
+        a2 = np.sqrt((channel.l - x)**2 + y**2)
+        b2 = 2*y - channel.D
+        c2 = np.sqrt((channel.l - x)**2 + (channel.D - y)**2)
+        epsilon = np.acos((a2**2 + b2**2 - c2**2)/(2*a2*b2))
+        up = (3*np.pi/2 - epsilon - Gamma < absolute_theta) & (absolute_theta < 3*np.pi/2 - epsilon)
+        return np.where(lower, low, up)
+
+    def check_rebound_condition_up_plane(self, idx, theta):
+        channel = self.channel
+        x, y = self.x[idx], self.y[idx]
+        lower = self.lower_mask(idx)
+        a = np.sqrt(x**2 + (channel.D - y)**2)
+        b = np.sqrt((channel.l-x)**2 + (channel.D - y)**2)
+        xi = np.acos((a**2 + b**2 - channel.l**2)/(2*a*b))
+        # Lower part of the conic section
+        absolute_theta = np.pi/2 + channel.alpha - theta
+        Gamma = xi # Same triangle as in the upper part
+        a2 = np.sqrt((channel.l - x)**2 + (channel.D - y)**2)
+        b2 = channel.D - 2*y
+        c2 = np.sqrt((channel.l - x)**2 + y**2)
+        epsilon = np.acos((a2**2 + b2**2 - c2**2)/(2*a2*b2))
+        low = (np.pi/2 + epsilon < absolute_theta) & (absolute_theta < np.pi/2 + epsilon + Gamma)
+        # Upper part of the conic section
+        absolute_theta = 3*np.pi/2 - channel.alpha + theta
+        up = (np.pi - channel.alpha < absolute_theta) & (absolute_theta < np.pi - channel.alpha + xi)
+        return np.where(lower, low, up)
+
+    def run(self, idx=None, checkpoint=None):
+        """
+        Run the simulation for all the particles of the batch at once.
+        idx are the particles still rebounding when continuing an interrupted run (None to start from scratch)
+        and checkpoint(idx) is called before every rebound round.
+        """
+        channel = self.channel
+        inst = self.instrumentation
+        if idx is None:
+            if inst is not None:
+                inst.enter("first_flight")
+            idx = np.arange(self.x.size)
+            # Compute the distance to the conic section and move every particle there (or to the outlet)
+            d1 = self.distance_to_conic_section_x(idx)
+            self.update_position(idx, d1/self.Vx[idx])
+            direct = np.abs(d1 - channel.L) < 1e-16
+            self.out[idx[direct]] = True
+            if inst is not None:
+                inst.event(DIRECT_EXIT, idx[direct], np.count_nonzero(direct))
+            idx = idx[~direct]
+
+        # Degenerate triangles give NaN angles, which make every comparison False as in the scalar path
+        with np.errstate(invalid='ignore', divide='ignore') if inst is None else inst.capture_invalid(divide='ignore'):
+            while idx.size > 0:
+                if checkpoint is not None:
+                    checkpoint(idx)
+                # Rebound with the conic section
+                if inst is not None:
+                    inst.enter("output_check")
+                theta = self.sample_angle(idx)
+                flag, gamma = self.check_output_condition(idx, theta)
+                exit_idx = idx[flag]
+                self.update_velocity_after_rebound(exit_idx, theta[flag])
+                self.update_position(exit_idx, self.check_output_time(exit_idx))
+                self.out[exit_idx] = True
+                idx, theta, gamma = idx[~flag], theta[~flag], gamma[~flag]
+                if inst is not None:
+                    inst.event(EXIT, exit_idx, exit_idx.size)
+                    inst.enter("conic_rebound")
+
+                # Rebound with the opposite conic wall, the particle stays active
+                conic = self.check_rebound_condition_conic_section(idx, theta, gamma)
+                conic_idx = idx[conic]
+                self.update_velocity_after_rebound(conic_idx, theta[conic])
+                self.update_position(conic_idx, self.check_rebound_time_conic_section(conic_idx))
+                if inst is not None:
+                    inst.event(CONIC_REBOUND, conic_idx, conic_idx.size)
+                    inst.enter("wall")
+
+                # Rest of particles get glued to the low plane, the up plane or the inlet
+                wall_idx, theta = idx[~conic], theta[~conic]
+                low = self.check_rebound_condition_low_plane(wall_idx, theta)
+                up = ~low & self.check_rebound_condition_up_plane(wall_idx, theta)
+                self.update_velocity_after_rebound(wall_idx, theta)
+                dt = np.where(low, -self.y[wall_idx]/self.Vy[wall_idx],
+                              np.where(up, (channel.D - self.y[wall_idx])/self.Vy[wall_idx], -self.x[wall_idx]/self.Vx[wall_idx]))
+                self.update_position(wall_idx, dt)
+                if inst is not None:
+                    inlet = ~low & ~up
+                    inst.event(LOW_PLANE, wall_idx[low], np.count_nonzero(low))
+                    inst.event(UP_PLANE, wall_idx[up], np.count_nonzero(up))
+                    inst.event(INLET, wall_idx[inlet], np.count_nonzero(inlet))
+
+                idx = conic_idx
+
+class GeometryEngine(BatchEngine):
+    def __init__(self, channel, x, y, Vx, Vy, kernel=None, record=FULL, max_bounces=None, fast_path=32):
+        """
+        Batch engine for any Geometry: the walls hit by the particles are found by ray casting instead of the
+        conditions derived by hand for the conic section, so asymmetric or multi-stage nozzles need no new branch.
+        Particles reaching max_bounces rebounds are stopped and flagged in capped (None for no cap). Rounds with no
+        more than fast_path active particles (the tail of long rebound chains) cast the rays with Geometry.cast_few,
+        which does not pay the fixed cost of the vectorized calls and gives the same results.
+        """
+        super().__init__(channel, x, y, Vx, Vy, kernel, record)
+        self.wall = np.full(self.x.size, -1) # Wall where each particle is placed (-1 before the first hit)
+        self.max_bounces = max_bounces # Rebounds after which a particle is stopped (None for no cap)
+        self.n_capped = 0 # Number of particles stopped by the bounce cap so far
+        self.fast_path = fast_path # Active particles below which the rays are cast one by one (None: never)
+
+    def cap(self, idx):
+        # Stop the particles of idx that reached the bounce cap and return the rest
+        if self.max_bounces is None:
+            return idx
+        capped = self.bounces[idx] >= self.max_bounces
+        self.capped[idx[capped]] = True
+        self.n_capped += int(np.count_nonzero(capped))
+        return idx[~capped]
+
+    def specular_angle(self, idx):
+        # Rebound angles (from the wall normal) that mirror the incoming velocities
+        theta = self.channel.normal_angle[self.wall[idx]] - np.arctan2(-self.Vy[idx], -self.Vx[idx])
+        return (theta + np.pi) % (2*np.pi) - np.pi
+
+    def update_velocity_after_rebound(self, idx, theta):
+        theta_abs = self.channel.normal_angle[self.wall[idx]] + theta
+        V = np.sqrt(self.Vx[idx]**2 + self.Vy[idx]**2)
+        self.Vx[idx] = V*np.cos(theta_abs)
+        self.Vy[idx] = V*np.sin(theta_abs)
+
+    def record_hits(self, idx, wall):
+        """
+        Feed the instrumentation with the walls just hit by the particles of idx: exits, rebounds and glued
+        particles (counted under the name of the wall).
+        """
+        inst, channel = self.instrumentation, self.channel
+        outlet = channel.is_outlet[wall]
+        direct = outlet & (self.bounces[idx] == 0)
+        inst.event(DIRECT_EXIT, idx[direct], np.count_nonzero(direct))
+        inst.event(EXIT, idx[outlet & ~direct], np.count_nonzero(outlet & ~direct))
+        rebound = channel.is_rebound[wall] & (self.bounces[idx] > 0) # The first contact with the cone is no rebound
+        inst.event(CONIC_REBOUND, idx[rebound], np.count_nonzero(rebound))
+        for k in np.unique(wall[~outlet & ~channel.is_rebound[wall]]):
+            inst.event(channel.names[k], idx[wall == k], np.count_nonzero(wall == k))
+
+    def run(self, idx=None, checkpoint=None):
+        """
+        Run the simulation for all the particles of the batch at once.
+        idx are the particles still rebounding when continuing an interrupted run (None to start from scratch)
+        and checkpoint(idx) is called before every rebound round.
+        """
+        channel = self.channel
+        inst = self.instrumentation
+        idx = np.arange(self.x.size) if idx is None else idx
+        while idx.size > 0:
+            if checkpoint is not None:
+                checkpoint(idx)
+            # Move every active particle to the first wall in its way
+            if inst is not None:
+                inst.enter("cast")
+            cast = channel.cast if self.fast_path is None or idx.size > self.fast_path else channel.cast_few
+            wall, dt = cast(self.x[idx], self.y[idx], self.Vx[idx], self.Vy[idx], self.wall[idx])
+            idx, wall, dt = idx[wall >= 0], wall[wall >= 0], dt[wall >= 0]
+            self.update_position(idx, dt)
+            self.wall[idx] = wall
+            self.out[idx[channel.is_outlet[wall]]] = True
+            if inst is not None:
+                self.record_hits(idx, wall)
+                inst.enter("rebound")
+            # Particles on rebounding walls stay active, the rest left or got glued
+            idx = self.cap(idx[channel.is_rebound[wall]])
+            self.update_velocity_after_rebound(idx, self.sample_angle(idx))
+
+class EventEngine(GeometryEngine):
+    def __init__(self, channel, x, y, Vx, Vy, kernel=None, record=FULL, batch_size=1024, max_bounces=None):
+        """
+        Event-driven version of GeometryEngine. The next wall hit of every particle is kept in a heap ordered by
+        absolute time and the events of all the particles are processed in global time order, so the simulation
+        can stop at any time horizon and resume later. Exits come out as a time-ordered stream. Up to batch_size
+        of the earliest events are popped and processed together.
+        """
+        super().__init__(channel, x, y, Vx, Vy, kernel, record, max_bounces, fast_path=None)
+        self.batch_size = batch_size # Maximum number of events processed at once
+        self.heap = [] # Pending events as (absolute time, particle index)
+        self.ready = [] # Heap of processed exits waiting for every earlier event to be processed
+        self.next_wall = np.full(self.x.size, -1) # Wall of the pending event of each particle
+        self.next_dt = np.zeros(self.x.size) # Time from the current position to the pending event
+        self.exits = [] # Indices of the particles that left the domain, in exit time order
+        self.started = False # True once the first events have been scheduled
+
+    def schedule(self, idx):
+        # Push the next wall hit of the particles of idx (particles that hit nothing are dropped)
+        wall, dt = self.channel.cast(self.x[idx], self.y[idx], self.Vx[idx], self.Vy[idx], self.wall[idx])
+        hit = wall >= 0
+        idx, wall, dt = idx[hit], wall[hit], dt[hit]
+        self.next_wall[idx] = wall
+        self.next_dt[idx] = dt
+        for t, i in zip((self.time[idx] + dt).tolist(), idx.tolist()):
+            heapq.heappush(self.heap, (t, i))
+
+    def events(self, horizon=np.inf):
+        """
+        Process the events up to the time horizon and yield (exit time, particle index) for every particle
+        leaving the domain, in time order. Calling it again with a later horizon resumes the simulation.
+        """
+        if not self.started:
+            if self.instrumentation is not None:
+                self.instrumentation.enter("cast")
+            self.schedule(np.arange(self.x.size))
+            self.started = True
+        heap, ready = self.heap, self.ready
+        while heap and heap[0][0] <= horizon:
+            self.process(horizon)
+            # An exit is final once no pending event is earlier, every later exit comes after it
+            bound = heap[0][0] if heap else np.inf
+            while ready and ready[0][0] <= bound:
+                t, i = heapq.heappop(ready)
+                self.exits.append(i)
+                yield t, i
+        while ready:
+            t, i = heapq.heappop(ready)
+            self.exits.append(i)
+            yield t, i
+
+    def process(self, horizon):
+        """
+        Pop up to batch_size of the earliest events before the time horizon and process them together (the
+        particles do not interact). The exits go to the ready heap and the rebounding particles are scheduled again.
+        """
+        channel, heap, inst = self.channel, self.heap, self.instrumentation
+        # Only around the processing: the floating point settings of the caller stay in place between the exits
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if inst is not None:
+                inst.enter("cast")
+            popped = []
+            while heap and heap[0][0] <= horizon and len(popped) < self.batch_size:
+                popped.append(heapq.heappop(heap)[1])
+            idx = np.array(popped)
+            self.update_position(idx, self.next_dt[idx])
+            wall = self.next_wall[idx]
+            self.wall[idx] = wall
+            exit_idx = idx[channel.is_outlet[wall]]
+            self.out[exit_idx] = True
+            if inst is not None:
+                self.record_hits(idx, wall)
+            for t, i in zip(self.time[exit_idx].tolist(), exit_idx.tolist()):
+                heapq.heappush(self.ready, (t, i))
+            if inst is not None:
+                inst.enter("rebound")
+            rebound_idx = self.cap(idx[channel.is_rebound[wall]])
+            self.update_velocity_after_rebound(rebound_idx, self.sample_angle(rebound_idx))
+            if inst is not None:
+                inst.enter("cast")
+            self.schedule(rebound_idx)
+
+    def advance(self, horizon):
+        """
+        Process every event up to the time horizon. Returns the number of particles that left so far.
+        """
+        for _ in self.events(horizon):
+            pass
+        return len(self.exits)
+
+    def outflow(self, times):
+        """
+        Cumulative number of particles that left the domain at each of the given (increasing) times.
+        Only the events up to the last time are simulated.
+        """
+        return np.array([self.advance(t) for t in times])
+
+    def run(self):
+        """
+        Run the simulation until every particle left the domain or got glued.
+        """
+        self.advance(np.inf)
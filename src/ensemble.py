@@ -0,0 +1,61 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from problem import Problem
+from trajectory import EXIT_TIME
+from sampling import UNIFORM
+
+def simulate_chunk(channel, n_particles, Vx, Vy, tol, engine, kernel, seed_seq, sampling=UNIFORM):
+    """
+    Simulate one chunk of particles with its own random generator and return its exit times.
+    """
+    problem = Problem(channel, n_particles, Vx, Vy, tol=tol, engine=engine, rng=np.random.default_rng(seed_seq),
+                      kernel=kernel, record=EXIT_TIME, sampling=sampling)
+    problem.distribute_initial_particles()
+    problem.run_simulation(verbose=False)
+    return problem.exit_times()
+
+class EnsembleResult:
+    def __init__(self, exit_times, n_particles, entropy, chunk_sizes=None, chunk_counts=None):
+        self.exit_times = exit_times # Exit times of all the particles that left the domain (in chunk order)
+        self.n_particles = n_particles # Number of particles simulated
+        self.chunk_sizes = chunk_sizes # Particles injected in each chunk (None if not known)
+        self.chunk_counts = chunk_counts # Particles that left the domain in each chunk (None if not known)
+        self.count = exit_times.size # Number of particles that left the domain
+        self.entropy = entropy # Entropy of the root SeedSequence, enough to reproduce the run
+
+    def compute_particles_flow_rate_interarrival(self):
+        """
+        Compute the flow rate of particles leaving the domain using the interarrival time method.
+        """
+        return 1/np.mean(np.diff(np.sort(self.exit_times)))
+
+    def compute_particles_flow_max_time(self):
+        """
+        Compute the flow rate of particles leaving the domain using the maximum time method.
+        """
+        return self.count/np.max(self.exit_times)
+
+def run_ensemble(channel, n_particles, Vx, Vy, seed=None, n_workers=None, chunk_size=100000, tol=0.01, engine="batch",
+                 kernel=None, sampling=UNIFORM):
+    """
+    Split a large simulation into chunks of chunk_size particles and run them over a process pool.
+    Each chunk gets its own np.random.Generator spawned from a single SeedSequence, so the result only
+    depends on the seed and the chunk size, not on the number of workers.
+    """
+    seed_seq = np.random.SeedSequence(seed)
+    n_chunks = -(-n_particles // chunk_size)
+    sizes = [min(chunk_size, n_particles - i*chunk_size) for i in range(n_chunks)]
+    child_seqs = seed_seq.spawn(n_chunks)
+    args = [(channel, size, Vx, Vy, tol, engine, kernel, child, sampling) for size, child in zip(sizes, child_seqs)]
+
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    if n_workers == 1 or n_chunks == 1:
+        chunks = [simulate_chunk(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_workers, n_chunks)) as pool:
+            # map keeps the chunk order, which makes the merge independent of the scheduling
+            chunks = list(pool.map(simulate_chunk, *zip(*args)))
+
+    exit_times = np.concatenate(chunks) if chunks else np.array([])
+    return EnsembleResult(exit_times, n_particles, seed_seq.entropy, np.array(sizes), np.array([c.size for c in chunks]))
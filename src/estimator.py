@@ -0,0 +1,232 @@
+import os
+import functools
+import numpy as np
+from statistics import NormalDist
+from concurrent.futures import ProcessPoolExecutor
+from ensemble import simulate_chunk
+from sampling import UNIFORM
+
+@functools.lru_cache()
+def t_quantile(p, dof, n=100001):
+    """
+    Quantile p (at least 0.5) of the Student's t distribution with dof degrees of freedom. With t = sqrt(dof)*tan(a)
+    its density is proportional to cos(a)**(dof - 1) on (-pi/2, pi/2), which is integrated numerically.
+    """
+    a = np.linspace(0, np.pi/2, n)
+    f = np.cos(a)**(dof - 1)
+    cdf = np.concatenate(([0], np.cumsum(f[1:] + f[:-1])))
+    return float(np.sqrt(dof)*np.tan(np.interp(p, 0.5 + 0.5*cdf/cdf[-1], a)))
+
+def needs_replicates(sampling=UNIFORM, kernel=None):
+    """
+    True if the particles of a chunk are not independent (stratified or Sobol heights, antithetic or common random
+    numbers), so that the errors must come from the spread between chunks instead of the delta method.
+    """
+    return sampling != UNIFORM or (kernel is not None and kernel.keyed)
+
+class FlowRateEstimator:
+    def __init__(self, confidence=0.95, replicated=False):
+        """
+        Online estimator of the particle flow rate. Exit times are fed in chunks and only running statistics are kept.
+        The flow rate per injected particle is q = p/tau, with p the probability of leaving through the outlet and
+        tau the mean exit time, so that N injected particles give a flow rate N*q. Its confidence interval is
+        obtained with the delta method, or, if replicated, from the spread of the chunks with a Student's t quantile
+        (see needs_replicates).
+        """
+        self.confidence = confidence # Confidence level of the intervals
+        self.replicated = replicated # Errors from the spread of the chunks instead of the delta method
+        self.n_injected = 0 # Number of particles injected
+        self.count = 0 # Number of particles that left the domain
+        self.mean = 0.0 # Running mean of the exit times
+        self.m2 = 0.0 # Running sum of squared deviations of the exit times
+        self.t_min = np.inf # Minimum exit time
+        self.t_max = -np.inf # Maximum exit time
+        self.entropy = None # Entropy of the root SeedSequence when the estimator is filled by run_until_converged
+        self.n_chunks = 0 # Number of chunks
+        self.chunk_mean = 0.0 # Running mean of the flow rates of the chunks
+        self.chunk_m2 = 0.0 # Running sum of squared deviations of the flow rates of the chunks
+
+    def update(self, exit_times, n_injected):
+        """
+        Add a chunk of n_injected particles whose exit times (only for the particles that left) are exit_times.
+        """
+        exit_times = np.asarray(exit_times, dtype=float)
+        self.n_injected += n_injected
+        n = exit_times.size
+        if n == 0:
+            if n_injected > 0:
+                # A chunk without exits is still a replicate, with flow rate 0
+                self.add_chunk(0.0)
+            return
+        # Chan et al. parallel update of the mean and the sum of squared deviations
+        mean = np.mean(exit_times)
+        m2 = np.sum((exit_times - mean)**2)
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta*n/total
+        self.m2 += m2 + delta**2*self.count*n/total
+        self.count = total
+        self.t_min = min(self.t_min, np.min(exit_times))
+        self.t_max = max(self.t_max, np.max(exit_times))
+        self.add_chunk(n/n_injected/mean)
+
+    def add_chunk(self, q):
+        """
+        Add the flow rate per injected particle q of a chunk to the running statistics of the chunks. Every chunk is
+        an independent replicate: their spread measures the variance of the estimator even when the particles inside
+        a chunk are not independent (stratified, Sobol or antithetic sampling).
+        """
+        self.n_chunks += 1
+        delta = q - self.chunk_mean
+        self.chunk_mean += delta/self.n_chunks
+        self.chunk_m2 += delta*(q - self.chunk_mean)
+
+    def transmission_probability(self):
+        return self.count/self.n_injected
+
+    def flow_rate(self):
+        """
+        Flow rate per injected particle q = p/tau [1/s].
+        """
+        return self.transmission_probability()/self.mean
+
+    def standard_error(self):
+        """
+        Standard error of the flow rate per injected particle (delta method, or spread of the chunks if replicated).
+        """
+        if self.replicated:
+            return np.sqrt(self.replicate_variance())
+        if self.count < 2:
+            return np.inf
+        p = self.transmission_probability()
+        var_p = p*(1 - p)/self.n_injected
+        var_tau = self.m2/(self.count - 1)/self.count
+        return self.flow_rate()*np.sqrt(var_p/p**2 + var_tau/self.mean**2)
+
+    def replicate_variance(self):
+        """
+        Variance of the flow rate per injected particle estimated from the spread of the chunk estimates.
+        Valid with every sampling mode, needs at least two chunks.
+        """
+        if self.n_chunks < 2:
+            return np.inf
+        return self.chunk_m2/(self.n_chunks - 1)/self.n_chunks
+
+    def confidence_interval(self):
+        if self.replicated and self.n_chunks >= 2:
+            z = t_quantile((1 + self.confidence)/2, self.n_chunks - 1)
+        else:
+            z = NormalDist().inv_cdf((1 + self.confidence)/2)
+        q, se = self.flow_rate(), self.standard_error()
+        return q - z*se, q + z*se
+
+    def relative_precision(self):
+        """
+        Half width of the confidence interval relative to the flow rate.
+        """
+        if self.count < 2:
+            return np.inf
+        low, high = self.confidence_interval()
+        return (high - low)/2/self.flow_rate()
+
+    def converged(self, rel_precision):
+        return self.relative_precision() <= rel_precision
+
+    def compute_particles_flow_rate_interarrival(self):
+        """
+        Same metric as Problem.compute_particles_flow_rate_interarrival: the mean of the sorted inter-arrival
+        times only depends on the first and last exit.
+        """
+        return (self.count - 1)/(self.t_max - self.t_min)
+
+    def compute_particles_flow_max_time(self):
+        """
+        Same metric as Problem.compute_particles_flow_max_time.
+        """
+        return self.count/self.t_max
+
+def run_until_converged(channel, Vx, Vy, rel_precision=0.01, chunk_size=100000, max_particles=10**8, seed=None,
+                        n_workers=1, tol=0.01, engine="batch", kernel=None, confidence=0.95, sampling=UNIFORM):
+    """
+    Inject batches of chunk_size particles until the flow rate reaches the requested relative precision
+    (or max_particles are injected). With variance-reduced sampling the precision comes from the spread of the
+    chunks, so the run stops as soon as the reduced variance allows. Chunks are fed to the estimator in order, so the stopping point and the
+    result only depend on the seed and the chunk size, not on the number of workers.
+    """
+    seed_seq = np.random.SeedSequence(seed)
+    estimator = FlowRateEstimator(confidence, needs_replicates(sampling, kernel))
+    estimator.entropy = seed_seq.entropy
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    pool = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    try:
+        while estimator.n_injected < max_particles:
+            # One chunk per worker, the spawned children keep their order across rounds
+            remaining = max_particles - estimator.n_injected
+            sizes = [min(chunk_size, remaining - i*chunk_size) for i in range(n_workers) if remaining > i*chunk_size]
+            args = [(channel, size, Vx, Vy, tol, engine, kernel, child, sampling)
+                    for size, child in zip(sizes, seed_seq.spawn(len(sizes)))]
+            if pool is None:
+                chunks = (simulate_chunk(*a) for a in args)
+            else:
+                chunks = pool.map(simulate_chunk, *zip(*args))
+            for size, exit_times in zip(sizes, chunks):
+                estimator.update(exit_times, size)
+                if estimator.converged(rel_precision):
+                    return estimator
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    return estimator
+
+class ChannelComparison:
+    def __init__(self, flow_rates):
+        """
+        Flow rates per injected particle of several channel variants, one row per replicate and one column per
+        channel. The replicates of all the channels share their random numbers (common random numbers).
+        """
+        self.flow_rates = flow_rates # (R, C) array of flow rates per injected particle
+        self.n_replicates = flow_rates.shape[0] # Number of replicates
+
+    def mean(self):
+        return self.flow_rates.mean(axis=0)
+
+    def variance(self):
+        """
+        Variance of the mean flow rate of each channel, from the spread of the replicates.
+        """
+        return self.flow_rates.var(axis=0, ddof=1)/self.n_replicates
+
+    def difference(self, i=1, j=0):
+        """
+        Mean difference of the flow rates of channels i and j.
+        """
+        return np.mean(self.flow_rates[:, i] - self.flow_rates[:, j])
+
+    def difference_variance(self, i=1, j=0):
+        """
+        Variance of the difference with paired replicates (common random numbers) and the variance it would
+        have with independent runs of the two channels.
+        """
+        paired = np.var(self.flow_rates[:, i] - self.flow_rates[:, j], ddof=1)/self.n_replicates
+        independent = self.variance()[i] + self.variance()[j]
+        return paired, independent
+
+def compare_channels(channels, n_particles, Vx, Vy, n_replicates=10, seed=None, n_workers=1, tol=0.01,
+                     engine="batch", kernel=None, sampling=UNIFORM):
+    """
+    Run n_replicates independent replicates of n_particles particles through every channel. Replicate r uses the
+    same spawned seed in every channel, so the initial heights (and, with a crn kernel, the rebound angles of each
+    particle) are shared: the differences between channels are then far less noisy than with independent runs.
+    """
+    seed_seq = np.random.SeedSequence(seed)
+    children = seed_seq.spawn(n_replicates)
+    args = [(channel, n_particles, Vx, Vy, tol, engine, kernel, child, sampling)
+            for child in children for channel in channels]
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    if n_workers == 1:
+        exits = [simulate_chunk(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            exits = list(pool.map(simulate_chunk, *zip(*args)))
+    q = np.array([e.size/n_particles/np.mean(e) if e.size else 0.0 for e in exits])
+    return ChannelComparison(q.reshape(n_replicates, len(channels)))
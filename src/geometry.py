@@ -0,0 +1,129 @@
+import shutil
+import numpy as np
+
+# Kinds of walls
+OUTLET = "outlet" # Particles reaching it leave the domain
+REBOUND = "rebound" # Particles rebound diffusely on it
+ABSORB = "absorb" # Particles reaching it get glued on it
+
+class Geometry:
+    def __init__(self, vertices, kinds, names):
+        """
+        Closed polygonal domain. Wall k goes from vertices[k] to vertices[k+1] (the last one closes the polygon),
+        kinds[k] is "outlet", "rebound" or "absorb" and names[k] is a label of the wall. The particles are
+        injected through the wall named "inlet", which must be the segment x = 0 from y = 0 to y = D.
+        Everything that only depends on the walls is computed once here.
+        """
+        self.vertices = np.asarray(vertices, dtype=float) # (K, 2) array of vertices
+        self.kinds = list(kinds) # Kind of each wall
+        self.names = list(names) # Label of each wall
+        self.start = self.vertices # Starting point of each wall
+        self.end = np.roll(self.vertices, -1, axis=0) # Ending point of each wall
+        self.edge = self.end - self.start # Vector along each wall
+        self.length = np.hypot(self.edge[:, 0], self.edge[:, 1]) # Length of each wall
+        self.tangent = self.edge/self.length[:, None] # Unit vector along each wall
+        # Inward normals: rotate the tangent 90 degrees towards the interior of the polygon
+        area = 0.5*np.sum(self.start[:, 0]*self.end[:, 1] - self.end[:, 0]*self.start[:, 1])
+        orientation = 1 if area > 0 else -1
+        self.normal = orientation*np.column_stack((-self.tangent[:, 1], self.tangent[:, 0])) # Unit inward normals
+        self.normal_angle = np.arctan2(self.normal[:, 1], self.normal[:, 0]) # Angle of the inward normals
+        self.is_outlet = np.array([k == OUTLET for k in self.kinds]) # Mask of outlet walls
+        self.is_rebound = np.array([k == REBOUND for k in self.kinds]) # Mask of rebounding walls
+        inlet = self.names.index("inlet")
+        ends = np.array([self.start[inlet], self.end[inlet]])
+        if np.any(np.abs(ends[:, 0]) > 1e-12) or abs(ends[:, 1].min()) > 1e-12:
+            # The particles are injected at x = 0 with heights between 0 and D
+            raise ValueError("The inlet must be the segment x = 0 from y = 0 to y = D, not from {} to {}".format(
+                tuple(ends[0].tolist()), tuple(ends[1].tolist())))
+        self.D = self.length[inlet] # Height of the inlet
+
+    @staticmethod
+    def nozzle(xs, lower, upper, kinds=None):
+        """
+        Nozzle with the inlet at x = 0 and the outlet at x = xs[-1]. The lower and upper walls go through the
+        points (xs, lower) and (xs, upper). kinds[i] is the kind of the i-th lower and upper walls; by default
+        the first ones glue the particles (as the planes of Channel) and the rest rebound them.
+        """
+        n = len(xs) - 1
+        kinds = [ABSORB] + [REBOUND]*(n - 1) if kinds is None else list(kinds)
+        vertices = [(x, y) for x, y in zip(xs, lower)] + [(x, y) for x, y in zip(xs[::-1], upper[::-1])]
+        wall_kinds = kinds + [OUTLET] + kinds[::-1] + [ABSORB]
+        names = ["low_{}".format(i) for i in range(n)] + ["outlet"] + ["up_{}".format(i) for i in range(n)][::-1] + ["inlet"]
+        return Geometry(vertices, wall_kinds, names)
+
+    def cast(self, x, y, dx, dy, exclude=None):
+        """
+        Vectorized ray-wall intersection. For rays starting at (x, y) with direction (dx, dy) return the index of
+        the first wall hit and the ray parameter t of the hit (a time if (dx, dy) is a velocity). The wall exclude
+        (the one the ray starts from) is skipped. Rays that hit nothing get wall -1 and t = inf.
+        """
+        ox = np.asarray(x, dtype=float)[:, None] - self.start[None, :, 0]
+        oy = np.asarray(y, dtype=float)[:, None] - self.start[None, :, 1]
+        dx = np.asarray(dx, dtype=float)[:, None]
+        dy = np.asarray(dy, dtype=float)[:, None]
+        ex, ey = self.edge[None, :, 0], self.edge[None, :, 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            denom = dx*ey - dy*ex
+            t = (ex*oy - ey*ox)/denom # Ray parameter
+            s = (dx*oy - dy*ox)/denom # Position along the wall (0 at start, 1 at end)
+        valid = (t > 1e-12) & (s >= -1e-12) & (s <= 1 + 1e-12)
+        if exclude is not None:
+            valid &= np.arange(self.length.size)[None, :] != np.asarray(exclude)[:, None]
+        t = np.where(valid, t, np.inf)
+        wall = np.argmin(t, axis=1)
+        t_hit = t[np.arange(wall.size), wall]
+        return np.where(np.isfinite(t_hit), wall, -1), t_hit
+
+    def cast_few(self, x, y, dx, dy, exclude=None):
+        """
+        Same as cast, looping over the rays and the walls. For a handful of rays the fixed cost of every NumPy call
+        dominates and this is several times faster. The arithmetic is the same, and so are the results.
+        """
+        walls = list(enumerate(zip(self.start[:, 0].tolist(), self.start[:, 1].tolist(), self.edge[:, 0].tolist(),
+                                   self.edge[:, 1].tolist())))
+        x, y = np.asarray(x, dtype=float).tolist(), np.asarray(y, dtype=float).tolist()
+        dx, dy = np.asarray(dx, dtype=float).tolist(), np.asarray(dy, dtype=float).tolist()
+        exclude = [-1]*len(x) if exclude is None else np.asarray(exclude).tolist()
+        wall, t_hit = [], []
+        for xi, yi, dxi, dyi, skip in zip(x, y, dx, dy, exclude):
+            hit, t_min = -1, np.inf
+            for k, (sx, sy, ex, ey) in walls:
+                denom = dxi*ey - dyi*ex
+                if k == skip or denom == 0: # Parallel rays never hit the wall (cast gets t or s infinite or NaN)
+                    continue
+                ox, oy = xi - sx, yi - sy
+                t = (ex*oy - ey*ox)/denom
+                s = (dxi*oy - dyi*ox)/denom
+                if 1e-12 < t < t_min and -1e-12 <= s <= 1 + 1e-12:
+                    hit, t_min = k, t
+            wall.append(hit)
+            t_hit.append(t_min)
+        return np.array(wall, dtype=np.int64), np.array(t_hit, dtype=float)
+
+    def draw(self, ax):
+        # Plot the walls on an existing axis
+        for start, end in zip(self.start, self.end):
+            ax.plot([start[0], end[0]], [start[1], end[1]], color='k', linewidth=2)
+
+    def visualize(self, visualize=False):
+        # Plotting modules are only imported when a figure is requested
+        import matplotlib.pyplot as plt
+        from plotting import figure_features
+
+        # For LaTeX labels rendering (plain labels when no LaTeX install is available)
+        figure_features(tex=shutil.which("latex") is not None)
+
+        # Figure
+        fig, ax = plt.subplots()
+        self.draw(ax)
+
+        # Labels
+        plt.xlabel(r'$x$')
+        plt.ylabel(r'$y$')
+
+        # If a quick visualization is needed
+        if visualize:
+            plt.show()
+        # To make the figure available for further animation
+        else:
+            return fig, ax
@@ -0,0 +1,97 @@
+import numpy as np
+from problem import Problem
+from estimator import FlowRateEstimator
+from trajectory import EXIT_TIME
+from sampling import UNIFORM
+
+def poisson_arrivals(rate, duration, rng, batch_size=100000):
+    """
+    Arrival times at the inlet of a Poisson process of the given rate over [0, duration], in arrays of
+    batch_size arrivals (the last one may be shorter).
+    """
+    t = 0.0
+    while t <= duration:
+        times = t + np.cumsum(rng.exponential(1/rate, batch_size))
+        t = times[-1]
+        times = times[times <= duration]
+        if times.size > 0:
+            yield times
+
+def simulate_arrivals(arrivals, channel, Vx, Vy, seed_seq, tol=0.01, engine="batch", kernel=None, sampling=UNIFORM):
+    """
+    Simulate every batch of arrivals with its own spawned random generator as soon as it comes and yield the
+    arrival times, the residence times and the mask of the particles that left through the outlet. Nothing is
+    kept once the batch is yielded.
+    """
+    for arrival in arrivals:
+        problem = Problem(channel, arrival.size, Vx, Vy, tol=tol, engine=engine,
+                          rng=np.random.default_rng(seed_seq.spawn(1)[0]), kernel=kernel, record=EXIT_TIME,
+                          sampling=sampling)
+        problem.distribute_initial_particles()
+        problem.run_simulation(verbose=False)
+        if problem.batch is not None:
+            out, residence = problem.batch.out, problem.batch.time
+        else:
+            out = np.array([p.out for p in problem.particles], dtype=bool)
+            residence = np.array([p.total_time if p.out else np.nan for p in problem.particles])
+        yield arrival, residence, out
+
+class InjectionResult:
+    def __init__(self, rate, duration, warmup, edges):
+        """
+        Running statistics of a continuous injection: particles arrive at the given rate during duration and the
+        throughput is measured over [warmup, duration], once the outflow reached its steady state.
+        """
+        self.rate = rate # Injection rate [particles/s]
+        self.duration = duration # Injection time [s]
+        self.warmup = warmup # Start of the steady-state window [s]
+        self.estimator = FlowRateEstimator() # Transmission probability and residence time statistics
+        self.edges = edges # Edges of the residence time histogram
+        self.counts = np.zeros(edges.size - 1, dtype=np.int64) # Residence time histogram
+        self.overflow = 0 # Residence times beyond the last edge
+        self.window_exits = 0 # Particles leaving during the steady-state window
+
+    def update(self, arrival, residence, out):
+        self.estimator.update(residence[out], arrival.size)
+        self.counts += np.histogram(residence[out], bins=self.edges)[0]
+        self.overflow += int(np.count_nonzero(residence[out] > self.edges[-1]))
+        departure = arrival[out] + residence[out]
+        self.window_exits += int(np.count_nonzero((departure >= self.warmup) & (departure <= self.duration)))
+
+    def throughput(self):
+        """
+        Measured steady-state outflow [particles/s].
+        """
+        return self.window_exits/(self.duration - self.warmup)
+
+    def expected_throughput(self):
+        """
+        Steady-state outflow predicted by the transmission probability: rate times p.
+        """
+        return self.rate*self.estimator.transmission_probability()
+
+    def residence_time_density(self):
+        """
+        Probability density of the residence time of the particles that left through the outlet and the edges
+        of its bins.
+        """
+        return self.counts/(self.estimator.count*np.diff(self.edges)), self.edges
+
+def run_injection(channel, rate, duration, Vx, Vy, warmup=None, batch_size=100000, seed=None, tol=0.01,
+                  engine="batch", kernel=None, sampling=UNIFORM, bins=200, max_residence=None):
+    """
+    Continuous injection of particles at x = 0 as a Poisson process of the given rate over [0, duration].
+    Arrivals are generated, simulated and retired in batches of batch_size particles, so memory does not
+    depend on the number of particles injected. The residence times are histogrammed over [0, max_residence]
+    (by default 50 times the crossing time L/V) and the throughput is measured after warmup (by default a
+    tenth of the duration).
+    """
+    seed_seq = np.random.SeedSequence(seed)
+    arrivals_rng = np.random.default_rng(seed_seq.spawn(1)[0])
+    warmup = duration/10 if warmup is None else warmup
+    max_residence = 50*channel.L/np.hypot(Vx, Vy) if max_residence is None else max_residence
+    result = InjectionResult(rate, duration, warmup, np.linspace(0, max_residence, bins + 1))
+    arrivals = poisson_arrivals(rate, duration, arrivals_rng, batch_size)
+    for arrival, residence, out in simulate_arrivals(arrivals, channel, Vx, Vy, seed_seq, tol, engine, kernel, sampling):
+        result.update(arrival, residence, out)
+    return result
@@ -0,0 +1,87 @@
+import time
+import numpy as np
+
+# Events counted by the instrumentation
+DIRECT_EXIT = "direct_exit" # Particle left without touching the conic section
+EXIT = "exit" # Particle left through the outlet after rebounding
+CONIC_REBOUND = "conic_rebound" # Rebound from one conic wall to the other
+LOW_PLANE = "low_plane" # Particle glued to the low plane
+UP_PLANE = "up_plane" # Particle glued to the up plane
+INLET = "inlet" # Particle glued to the inlet
+EVENTS = (DIRECT_EXIT, EXIT, CONIC_REBOUND, LOW_PLANE, UP_PLANE, INLET)
+
+class Instrumentation:
+    def __init__(self, timings=True):
+        """
+        Counters, bounce histograms, per-branch timings and hooks of a simulation. Pass it to Problem and read it
+        after run_simulation. Problem only touches it when it is given, so leaving it out costs nothing.
+        Invalid floating point operations (np.acos of an argument out of [-1, 1], which returns NaN) are counted
+        per branch: exactly with the scalar engine, once per vectorized call with the batch engines.
+        """
+        self.counters = dict.fromkeys(EVENTS, 0) # Number of times each event happened
+        self.invalid = {} # Invalid floating point operations (NaN acos) per branch
+        self.time = {} # Cumulative wall time per branch [s]
+        self.timings = timings # Measure the branch timings
+        self.hooks = [] # Callbacks called as hook(event, ids) on every event
+        self.exit_bounces = np.zeros(0, dtype=np.int64) # Bounce histogram of the particles that left
+        self.glued_bounces = np.zeros(0, dtype=np.int64) # Bounce histogram of the particles that got glued
+        self.branch = None # Branch being run
+        self.t0 = 0.0 # Time the branch started
+
+    def add_hook(self, hook):
+        """
+        Register hook(event, ids), called on every event with the indices of the particles involved (an int with
+        the scalar engine, an array with the batch engines).
+        """
+        self.hooks.append(hook)
+
+    def event(self, name, ids, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+        for hook in self.hooks:
+            hook(name, ids)
+
+    def enter(self, branch):
+        # Close the running branch and start measuring the next one (None closes without opening another)
+        if self.timings:
+            now = time.perf_counter()
+            if self.branch is not None:
+                self.time[self.branch] = self.time.get(self.branch, 0.0) + now - self.t0
+            self.t0 = now
+        self.branch = branch
+
+    def on_invalid(self, kind, flag):
+        # Called by NumPy on invalid floating point operations while the simulation runs
+        self.invalid[self.branch] = self.invalid.get(self.branch, 0) + 1
+
+    def capture_invalid(self, **kwargs):
+        """
+        Context manager that routes the invalid floating point operations to on_invalid (kwargs set the handling
+        of the other floating point errors, as in np.errstate).
+        """
+        return np.errstate(invalid='call', call=self.on_invalid, **kwargs)
+
+    def finish(self, bounces, out):
+        """
+        Add the rebound counts of particles that finished, out telling which ones left the domain.
+        """
+        bounces, out = np.asarray(bounces), np.asarray(out, dtype=bool)
+        self.exit_bounces = _add_counts(self.exit_bounces, np.bincount(bounces[out]))
+        self.glued_bounces = _add_counts(self.glued_bounces, np.bincount(bounces[~out]))
+
+    def bounce_histogram(self, fate=EXIT):
+        """
+        Number of particles with 0, 1, 2... rebounds among those that left ("exit") or got glued ("glued").
+        """
+        return self.exit_bounces if fate == EXIT else self.glued_bounces
+
+    def summary(self):
+        return {"counters": dict(self.counters), "invalid": dict(self.invalid), "time": dict(self.time),
+                "exit_bounces": self.exit_bounces.tolist(), "glued_bounces": self.glued_bounces.tolist()}
+
+def _add_counts(a, b):
+    # Sum of two bincounts of different lengths
+    if a.size < b.size:
+        a, b = b, a
+    a = a.copy()
+    a[:b.size] += b
+    return a
@@ -0,0 +1,118 @@
+import numpy as np
+from diffuse import CosineKernel
+from estimator import t_quantile
+from sampling import STRATIFIED
+from sweep import sweep_points
+
+class Evaluation:
+    def __init__(self, l, d, point):
+        self.l = l # Start of the conical section
+        self.d = d # Diameter of the outlet
+        self.point = point # SweepPoint with the largest budget simulated so far
+        self.n_particles = point.result.n_particles # Particles simulated for this geometry
+
+    def flow_rate(self):
+        return self.point.estimator.flow_rate()
+
+    def standard_error(self):
+        # Spread of the chunk estimates, valid with correlated sampling inside the chunks
+        return np.sqrt(self.point.estimator.replicate_variance())
+
+class OptimizationResult:
+    def __init__(self, best, step, evaluations, confidence):
+        self.channel = best.point.channel # Best Channel found
+        self.l, self.d = best.l, best.d # Best geometry parameters
+        self.flow_rate = best.flow_rate() # Flow rate per injected particle of the best geometry
+        self.standard_error = best.standard_error() # Standard error of its flow rate
+        # The standard error comes from the spread of a few chunks: Student's t quantile
+        z = t_quantile((1 + confidence)/2, max(best.point.chunk_flow_rates.size - 1, 1))
+        self.confidence_interval = (self.flow_rate - z*self.standard_error, self.flow_rate + z*self.standard_error)
+        self.l_resolution, self.d_resolution = step # Spacing of the last candidate grid around the optimum
+        self.evaluations = evaluations # Evaluation of every geometry visited
+        self.n_simulated = sum(e.n_particles for e in evaluations) # Particles simulated (or read from cache)
+
+class GeometryOptimizer:
+    def __init__(self, L, D, Vx, Vy, seed, l_range=None, d_range=None, n_particles=40000, max_particles=10**6,
+                 chunk_size=10000, kernel=None, sampling=STRATIFIED, confidence=0.95, cache_dir="sweep_cache",
+                 n_workers=None, tol=0.01, engine="batch"):
+        """
+        Search of the l and d that maximize the flow rate of a Channel of length L and inlet D.
+        Every geometry is simulated with the same seed, the same chunks and (by default) a common random numbers
+        kernel, so that the differences between candidates are far less noisy than their flow rates. Evaluations
+        are memoized (in memory and in the sweep cache on disk) and a budget is only increased, by simulating the
+        missing chunks, for the candidates that cannot be told apart from the best one.
+        """
+        self.L, self.D, self.Vx, self.Vy, self.seed = L, D, Vx, Vy, seed
+        self.l_range = (0.05*L, 0.95*L) if l_range is None else l_range # Search interval of l
+        self.d_range = (0.05*D, 0.95*D) if d_range is None else d_range # Search interval of d
+        self.n_particles = n_particles # Initial budget of every candidate
+        self.max_particles = max_particles # Largest budget of a candidate
+        self.kernel = CosineKernel(crn=True) if kernel is None else kernel # Scattering kernel
+        self.confidence = confidence # Confidence level of the comparisons
+        self.options = dict(cache_dir=cache_dir, kernel=self.kernel, n_workers=n_workers, chunk_size=chunk_size,
+                            tol=tol, engine=engine, confidence=confidence, sampling=sampling)
+        self.evaluations = {} # Memoized evaluations, keyed by (l, d)
+
+    def evaluate(self, candidates, n_particles):
+        """
+        Bring every candidate (l, d) to a budget of at least n_particles, simulating them together.
+        """
+        todo = [c for c in candidates if c not in self.evaluations or self.evaluations[c].n_particles < n_particles]
+        if todo:
+            points = sweep_points([(l, self.L, d, self.D) for l, d in todo], n_particles, self.Vx, self.Vy, self.seed,
+                                  **self.options)
+            for (l, d), point in zip(todo, points):
+                self.evaluations[(l, d)] = Evaluation(l, d, point)
+        return [self.evaluations[c] for c in candidates]
+
+    def worse(self, a, b):
+        """
+        True if a is significantly worse than b: paired t-test on their common chunks (there are only a few of
+        them, so a normal quantile would drop close candidates too early).
+        """
+        m = min(a.point.chunk_flow_rates.size, b.point.chunk_flow_rates.size)
+        diff = b.point.chunk_flow_rates[:m] - a.point.chunk_flow_rates[:m]
+        if m < 2:
+            return False
+        t = t_quantile((1 + self.confidence)/2, m - 1)
+        return np.mean(diff) > t*np.std(diff, ddof=1)/np.sqrt(m)
+
+    def grid(self, center, step, n_grid):
+        # Candidates of a n_grid x n_grid grid around center, clipped to the search intervals
+        offsets = np.arange(n_grid) - (n_grid - 1)/2
+        ls = np.clip(center[0] + offsets*step[0], *self.l_range)
+        ds = np.clip(center[1] + offsets*step[1], *self.d_range)
+        return sorted({(round(float(l), 12), round(float(d), 12)) for l in ls for d in ds})
+
+    def run(self, n_grid=5, resolution=0.01, max_iter=20):
+        """
+        Pattern search: evaluate a grid around the best geometry, refine the budgets of the candidates that
+        cannot be told apart from it, then halve the grid spacing. Stops when the spacing is below resolution
+        (relative to the search intervals) or after max_iter grids.
+        """
+        center = (np.mean(self.l_range), np.mean(self.d_range))
+        step = ((self.l_range[1] - self.l_range[0])/(n_grid - 1), (self.d_range[1] - self.d_range[0])/(n_grid - 1))
+        for _ in range(max_iter):
+            candidates = self.grid(center, step, n_grid)
+            evaluations = self.evaluate(candidates, self.n_particles)
+            while True:
+                best = max(evaluations, key=Evaluation.flow_rate)
+                contenders = [e for e in evaluations if e is not best and not self.worse(e, best)]
+                refine = [e for e in contenders + [best] if e.n_particles < self.max_particles]
+                if not contenders or not refine:
+                    break
+                budget = min(2*max(e.n_particles for e in refine), self.max_particles)
+                self.evaluate([(e.l, e.d) for e in refine], budget)
+                evaluations = [self.evaluations[c] for c in candidates]
+            center = (best.l, best.d)
+            if step[0] <= resolution*(self.l_range[1] - self.l_range[0]) and \
+               step[1] <= resolution*(self.d_range[1] - self.d_range[0]):
+                break
+            step = (step[0]/2, step[1]/2)
+        return OptimizationResult(best, step, list(self.evaluations.values()), self.confidence)
+
+def optimize_geometry(L, D, Vx, Vy, seed, n_grid=5, resolution=0.01, max_iter=20, **kwargs):
+    """
+    Best l and d of a Channel of length L and inlet D for the flow rate, see GeometryOptimizer.
+    """
+    return GeometryOptimizer(L, D, Vx, Vy, seed, **kwargs).run(n_grid, resolution, max_iter)
@@ -1,18 +1,35 @@
 import numpy as np
+from trajectory import FULL, ENDPOINTS
+
 class Particle:
-    def __init__(self, x, y, Vx, Vy):
+    __slots__ = ("x", "y", "Vx", "Vy", "time", "trayectory", "velocities", "out", "total_time", "record", "index",
+                 "bounces")
+
+    def __init__(self, x, y, Vx, Vy, record=FULL, index=0):
         self.x = x # intial x-coordinate of the particles
         self.y = y # initial y-coordinate of the particles
         self.Vx = Vx # x-component of the velocity of the particles at the initial time
         self.Vy = Vy # y-component of the velocity of the particles at the initial time
-        self.time = [] # Time taken by the particle to follow each trajectory
-        self.trayectory = [(x, y)] # Array of the particle's position
-        self.velocities = [(Vx, Vy)] # Array of the particle's velocity at each position
+        self.record = record # Recording level of the trajectory: "full", "endpoints" or "exit_time"
+        self.total_time = 0.0 # Accumulated time of flight of the particle
+        if record == FULL:
+            self.time = [] # Time taken by the particle to follow each trajectory
+            self.trayectory = [(x, y)] # Array of the particle's position
+            self.velocities = [(Vx, Vy)] # Array of the particle's velocity at each position
+        elif record == ENDPOINTS:
+            # A single segment from the initial to the current position
+            self.time = [0.0]
+            self.trayectory = [(x, y), (x, y)]
+            self.velocities = [(Vx, Vy)]
+        else:
+            self.time = self.trayectory = self.velocities = None
         self.out = False # Boolean variable to check if the particle left the domain
+        self.index = index # Position of the particle in the Problem (keys its common random numbers)
+        self.bounces = 0 # Number of rebounds of the particle
     
     def update_velocity_after_rebound(self, channel, theta):
         # If particle is in the upper part of the conic section
-        if (channel.D + channel.d)/2 < self.y < channel.D:
+        if channel.y_up < self.y < channel.D:
             theta_abs = 3*np.pi/2 - channel.alpha + theta
         # If particle is in the lower part of the conic section
         else:
@@ -22,34 +39,52 @@ class Particle:
         self.Vx = V*np.cos(theta_abs)
         self.Vy = V*np.sin(theta_abs)
         
-        self.velocities.append((self.Vx, self.Vy))
+        if self.record == FULL:
+            self.velocities.append((self.Vx, self.Vy))
+        elif self.record == ENDPOINTS:
+            self.velocities[0] = (self.Vx, self.Vy)
     
+    def specular_angle(self, channel):
+        # Rebound angle (from the wall normal) that mirrors the incoming velocity
+        if channel.y_up < self.y < channel.D:
+            normal = 3*np.pi/2 - channel.alpha
+            theta = normal - np.arctan2(-self.Vy, -self.Vx)
+        else:
+            normal = np.pi/2 + channel.alpha
+            theta = np.arctan2(-self.Vy, -self.Vx) - normal
+        return (theta + np.pi) % (2*np.pi) - np.pi
+
     def update_position(self, dt):
         self.x += self.Vx*dt
         self.y += self.Vy*dt
-        self.trayectory.append((self.x, self.y))
-        self.time.append(dt)
+        self.total_time += dt
+        if self.record == FULL:
+            self.trayectory.append((self.x, self.y))
+            self.time.append(dt)
+        elif self.record == ENDPOINTS:
+            self.trayectory[1] = (self.x, self.y)
+            self.time[0] = self.total_time
     
     def distance_to_conic_section_x(self, channel):
         # Upper part of the conic section
-        if (channel.D + channel.d)/2 < self.y < channel.D:
-            return channel.l +  (channel.L-channel.l)/((channel.d-channel.D)/2)*(self.y - channel.D)
+        if channel.y_up < self.y < channel.D:
+            return channel.l + (self.y - channel.D)/channel.m_up
         # Lower part of the conic section
-        elif 1e-16 < self.y < (channel.D - channel.d)/2:
-            return channel.l + (channel.L-channel.l)/((channel.D-channel.d)/2)*self.y
+        elif 1e-16 < self.y < channel.y_low:
+            return channel.l + self.y/channel.m_low
         # Not in the conic section automatically left the channel
         else:
             return channel.L
     
     def check_output_condition(self, channel, theta):
         # Upper part of the conic section
-        if (channel.D + channel.d)/2 < self.y < channel.D:
-            a = np.sqrt((channel.L-self.x)**2 + ((channel.D+channel.d)/2-self.y)**2)
-            b = np.sqrt((channel.L-self.x)**2 + ((channel.D-channel.d)/2-self.y)**2) 
+        if channel.y_up < self.y < channel.D:
+            a = np.sqrt((channel.L-self.x)**2 + (channel.y_up-self.y)**2)
+            b = np.sqrt((channel.L-self.x)**2 + (channel.y_low-self.y)**2) 
         # Lower part of the conic section
         elif 1e-16 < self.y < channel.L:
-            a = np.sqrt((channel.L-self.x)**2 + ((channel.D-channel.d)/2-self.y)**2)
-            b = np.sqrt((channel.L-self.x)**2 + ((channel.D+channel.d)/2-self.y)**2)
+            a = np.sqrt((channel.L-self.x)**2 + (channel.y_low-self.y)**2)
+            b = np.sqrt((channel.L-self.x)**2 + (channel.y_up-self.y)**2)
 
         gamma = np.acos((a**2 + b**2 - channel.d**2)/(2*a*b))
         if theta > (np.pi/2 - gamma):
@@ -62,17 +97,17 @@ class Particle:
         
     def check_rebound_condition_conic_section(self, channel, theta, gamma):
         # Upper part of the conic section
-        if (channel.D + channel.d)/2 < self.y < channel.D:
+        if channel.y_up < self.y < channel.D:
             a = np.sqrt((channel.l-self.x)**2 + (self.y)**2)
-            b = np.sqrt((channel.L-self.x)**2 + ((channel.D-channel.d)/2-self.y)**2)
-            c = np.sqrt((channel.L-channel.l)**2 + ((channel.D-channel.d)/2)**2)
+            b = np.sqrt((channel.L-self.x)**2 + (channel.y_low-self.y)**2)
+            c = channel.c
             xi = np.acos((a**2 + b**2 - c**2)/(2*a*b))
         
         # Lower part of the conic section
-        elif 1e-16 < self.y < (channel.D - channel.d)/2:
+        elif 1e-16 < self.y < channel.y_low:
             a = np.sqrt((channel.l-self.x)**2 + (self.y-channel.D)**2)
-            b = np.sqrt((channel.L-self.x)**2 + ((channel.D+channel.d)/2-self.y)**2)
-            c = np.sqrt((channel.L-channel.l)**2 + ((channel.D+channel.d)/2-channel.D)**2)
+            b = np.sqrt((channel.L-self.x)**2 + (channel.y_up-self.y)**2)
+            c = channel.c
             xi = np.acos((a**2 + b**2 - c**2)/(2*a*b))
         
         if (np.pi/2 - gamma - xi) < theta < (np.pi/2 - gamma):
@@ -82,22 +117,20 @@ class Particle:
     
     def check_rebound_time_conic_section(self, channel):
         # Upper part of the conic section
-        if (channel.D + channel.d)/2 < self.y < channel.D:
+        if channel.y_up < self.y < channel.D:
             # Time to reach the lower conic section
-            m = (channel.D-channel.d)/(2*(channel.L-channel.l))
-            b = -m*channel.l
+            m, b = channel.m_low, channel.b_low
             return (self.y - m*self.x - b)/(m*self.Vx - self.Vy)
         # Lower part of the conic section
         else:
             # Time to reach the upper conic section
-            m = (channel.d-channel.D)/(2*(channel.L-channel.l)) # Slope of the conic section
-            b = -m*channel.l + channel.D # y-intercept of the conic section
+            m, b = channel.m_up, channel.b_up # Slope and y-intercept of the conic section
             return (self.y - m*self.x - b)/(m*self.Vx - self.Vy)
        
     
     def check_rebound_condition_low_plane(self, channel, theta):
         # Lower part of the conic section
-        if 1e-16 < self.y < (channel.D - channel.d)/2:
+        if 1e-16 < self.y < channel.y_low:
             absolute_theta = np.pi/2 + channel.alpha - theta
             a = np.sqrt(self.x**2 + self.y**2)
             b = np.sqrt((channel.l-self.x)**2 + self.y**2)
@@ -128,7 +161,7 @@ class Particle:
     
     def check_rebound_condition_up_plane(self, channel, theta):
         # Lower part of the conic section
-        if 1e-16 < self.y < (channel.D - channel.d)/2:
+        if 1e-16 < self.y < channel.y_low:
             absolute_theta = np.pi/2 + channel.alpha - theta
             a1 = np.sqrt(self.x**2 + (channel.D - self.y)**2)
             b1 = np.sqrt((channel.l-self.x)**2 + (channel.D - self.y)**2)
@@ -0,0 +1,189 @@
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.animation import FuncAnimation, FFMpegWriter, AbstractMovieWriter
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.ticker import MultipleLocator
+from PIL import Image, GifImagePlugin
+from trajectory import TrajectoryStore
+from utils import interpolate_trayectory, interpolate_positions
+
+def visualize_simulation_single_particle(particle, channel, dt_sim=0.15):
+        """
+        Animate the trayectory of a single particle..
+        """
+       
+        smooth_traj = interpolate_trayectory(particle, dt_sim=dt_sim)
+        
+        # Use the channel's visualization method to get background figure
+        fig, ax = channel.visualize(False)
+        # Create a marker for the particle.
+        particle_marker, = ax.plot([], [], 'bo', markersize=8)
+        ax.legend()
+        
+        def init():
+            particle_marker.set_data([], [])
+            return (particle_marker,)
+        
+        def update(frame):
+            x, y = smooth_traj[frame, 1], smooth_traj[frame, 2]
+            particle_marker.set_data([x], [y])
+            return (particle_marker,)
+        
+        frames = range(len(smooth_traj))
+        ani = FuncAnimation(fig, update, frames=frames, init_func=init,
+                            blit=True)
+        # Save the animation as a GIF using PillowWriter.
+        # writer = PillowWriter() 
+        # ani.save("./images/simulation.gif", writer=writer)
+        plt.show()
+
+def visualize_simulation_all_particles(channel, particles, n_frames=200):
+    """
+    Animate the movement of all particles over simulation time T.
+    particles is a list of Particle objects (with their full trajectory recorded) or a TrajectoryStore.
+    All the frame positions are computed at once and the particles are drawn with a single scatter artist.
+    For particles that finish before T, we hold their final position constant.
+    """
+    store = particles if isinstance(particles, TrajectoryStore) else TrajectoryStore.from_particles(particles)
+    T = store.total_times().max() # Maximum time taken by a particle to leave the domain.
+    positions = interpolate_positions(store, np.linspace(0, T, n_frames))
+
+    # Get figure and axis from the channel's visualization method.
+    fig, ax = channel.visualize(False)
+    markers = ax.scatter(positions[0, :, 0], positions[0, :, 1], s=16, color='b')
+
+    def update(frame):
+        markers.set_offsets(positions[frame])
+        return (markers,)
+
+    ani = FuncAnimation(fig, update, frames=n_frames, blit=True)
+    plt.show()
+    return ani
+
+class StreamingGifWriter(AbstractMovieWriter):
+    """
+    GIF writer that encodes and writes every frame as soon as it is grabbed, so the frames are never held
+    in memory (matplotlib's PillowWriter keeps all of them until the end). All frames share the palette of
+    the first one.
+    """
+    def setup(self, fig, outfile, dpi=None):
+        super().setup(fig, outfile, dpi=dpi)
+        self._file = open(outfile, "wb")
+        self._palette = None
+
+    def grab_frame(self, **savefig_kwargs):
+        self.fig.canvas.draw()
+        frame = Image.fromarray(np.asarray(self.fig.canvas.buffer_rgba())[..., :3])
+        if self._palette is None:
+            self._palette = frame.quantize(colors=256)
+            header, _ = GifImagePlugin.getheader(self._palette, info={"loop": 0, "optimize": False})
+            self._file.write(b"".join(header))
+            frame = self._palette
+        else:
+            frame = frame.quantize(palette=self._palette)
+        for chunk in GifImagePlugin.getdata(frame, duration=1000/self.fps):
+            self._file.write(chunk)
+
+    def finish(self):
+        self._file.write(b";") # GIF trailer
+        self._file.close()
+
+def export_simulation(channel, particles, filename, n_frames=200, fps=20, dpi=100, max_positions=10**7):
+    """
+    Render the animation of all the particles to a GIF or MP4 file without a display.
+    Frame positions are computed in vectorized blocks of at most max_positions particle positions and every
+    frame is streamed to the writer (ffmpeg for MP4, StreamingGifWriter for GIF) right after being drawn.
+    """
+    store = particles if isinstance(particles, TrajectoryStore) else TrajectoryStore.from_particles(particles)
+    times = np.linspace(0, store.total_times().max(), n_frames)
+
+    # Headless figure (Agg canvas, no pyplot) with plain text labels so that no TeX install is needed
+    with matplotlib.rc_context({"text.usetex": False}):
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        channel.draw(ax)
+        ax.set_xlabel(r'$x$')
+        ax.set_ylabel(r'$y$')
+        markers = ax.scatter([], [], s=4, color='b')
+
+        writer = StreamingGifWriter(fps=fps) if filename.endswith(".gif") else FFMpegWriter(fps=fps)
+        block = max(1, max_positions//max(1, len(store)))
+        with writer.saving(fig, filename, dpi):
+            for i in range(0, n_frames, block):
+                for positions in interpolate_positions(store, times[i:i + block]):
+                    markers.set_offsets(positions)
+                    writer.grab_frame()
+
+# Function to make high quality plots    
+def figure_features(tex=True, font="serif", dpi=180):
+    """Customize figure settings.
+
+    Args:
+        tex (bool, optional): use LaTeX. Defaults to True.
+        font (str, optional): font type. Defaults to "serif".
+        dpi (int, optional): dots per inch. Defaults to 180.
+    """
+    plt.rcParams.update(
+        {
+            "font.size": 14,
+            "font.family": font,
+            "text.usetex": tex,
+            "figure.subplot.top": 0.9,
+            "figure.subplot.right": 0.9,
+            "figure.subplot.left": 0.15,
+            "figure.subplot.bottom": 0.15,
+            "figure.subplot.hspace": 0.2,
+            "savefig.dpi": dpi,
+            "savefig.format": "pdf",
+            "axes.titlesize": 11,
+            "axes.labelsize": 11,
+            "axes.axisbelow": True,
+            "xtick.direction": "in",
+            "ytick.direction": "in",
+            "xtick.major.size": 5,
+            "xtick.minor.size": 2.25,
+            "xtick.major.pad": 7.5,
+            "xtick.minor.pad": 7.5,
+            "ytick.major.pad": 7.5,
+            "ytick.minor.pad": 7.5,
+            "ytick.major.size": 5,
+            "ytick.minor.size": 2.25,
+            "xtick.labelsize": 11,
+            "ytick.labelsize": 11,
+            "legend.fontsize": 11,
+            "legend.framealpha": 1,
+            "figure.titlesize": 16,
+            "lines.linewidth": 2,
+        }
+    )
+
+
+def add_grid(ax, lines=True, locations=None):
+    """Add a grid to the current plot.
+
+    Args:
+        ax (Axis): axis object in which to draw the grid.
+        lines (bool, optional): add lines to the grid. Defaults to True.
+        locations (tuple, optional):
+            (xminor, xmajor, yminor, ymajor). Defaults to None.
+    """
+
+    if lines:
+        ax.grid(lines, alpha=0.5, which="minor", ls=":")
+        ax.grid(lines, alpha=0.7, which="major")
+
+    if locations is not None:
+
+        assert (
+            len(locations) == 4
+        ), "Invalid entry for the locations of the markers"
+
+        xmin, xmaj, ymin, ymaj = locations
+
+        ax.xaxis.set_minor_locator(MultipleLocator(xmin))
+        ax.xaxis.set_major_locator(MultipleLocator(xmaj))
+        ax.yaxis.set_minor_locator(MultipleLocator(ymin))
+        ax.yaxis.set_major_locator(MultipleLocator(ymaj))
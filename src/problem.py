@@ -1,14 +1,36 @@
+import os
+import time
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
-from diffuse import Diffuse
+from diffuse import CosineKernel
 from particles import Particle
+from engine import BatchEngine, GeometryEngine, EventEngine
+from channel import GLUE
+from trajectory import FULL, EXIT_TIME, TrajectoryStore
+from sampling import UNIFORM, sample_heights, antithetic_heights
+from checkpoint import save_checkpoint, load_checkpoint, problem_state, restore_problem
+from instrument import DIRECT_EXIT, EXIT, CONIC_REBOUND, LOW_PLANE, UP_PLANE, INLET
 
 class Problem:
-    def __init__(self, channel, n_particles, Vx, Vy, tol=0.01):
+    def __init__(self, channel, n_particles, Vx, Vy, tol=0.01, engine="scalar", rng=None, kernel=None,
+                 record=FULL, sampling=UNIFORM, instrumentation=None, max_bounces=None):
         """
         Initialize the simulation with a computational domain (channel) and a number of particles.
+        The engine can be "scalar" (one Particle object at a time), "batch" (vectorized BatchEngine) or
+        "geometry" (vectorized GeometryEngine, valid for any Geometry and not only for Channel) or "event"
+        (EventEngine, processes the wall hits of all the particles in time order and can stop at a time horizon).
+        All the random numbers are drawn from rng (a np.random.Generator), or from the global np.random state if None.
+        The kernel sets the rebound law (Knudsen cosine law if None); it is bound to rng before being used.
+        The record level sets what is stored of each trajectory: "full", "endpoints" or "exit_time".
+        The sampling of the initial heights can be "uniform", "stratified" or "sobol".
+        An Instrumentation object, if given, collects event counters, bounce histograms and branch timings.
+        With the ray casting engines ("geometry" and "event") particles are stopped after max_bounces rebounds
+        and counted in n_capped instead of being followed forever (None for no cap). A Channel whose planes
+        reflect the particles (planes="reflect") needs one of these engines.
         """
+        if getattr(channel, "planes", GLUE) != GLUE and engine in ("scalar", "batch"):
+            raise ValueError("Reflecting planes need the geometry or the event engine")
+        if max_bounces is not None and engine in ("scalar", "batch"):
+            raise ValueError("The bounce cap needs the geometry or the event engine")
         self.channel = channel # Channel object
         self.n_particles = n_particles # Number of particles to simulate
         self.Vx = Vx # Initial x-velocity of the particles
@@ -16,20 +38,62 @@ class Problem:
         self.tol = tol # Tolerance for initial y positions to do not have particles very close to the walls.
         self.particles = [] # List of Particle objects
         self.count = 0 # Number of particles that left the domain.
+        self.engine = engine # Simulation engine: "scalar", "batch", "geometry" or "event"
+        self.batch = None # BatchEngine object when a vectorized engine is used
+        self.rng = np.random if rng is None else rng # Random generator
+        self.kernel = (CosineKernel() if kernel is None else kernel).with_rng(rng) # Scattering kernel
+        self.record = record # Recording level of the trajectories
+        self.sampling = sampling # Sampling mode of the initial heights
+        self.instrumentation = instrumentation # Instrumentation object (None to run without it)
+        self.max_bounces = max_bounces # Bounce cap of the ray casting engines
+        self.n_capped = 0 # Number of particles stopped by the bounce cap
     
     def distribute_initial_particles(self):
         """
         Generate particles with x = 0 and uniformly distributed y positions.
         """
+        if self.kernel.antithetic:
+            y_init = antithetic_heights(self.n_particles, self.tol, self.channel.D - self.tol, self.rng, self.sampling)
+        else:
+            y_init = sample_heights(self.n_particles, self.tol, self.channel.D - self.tol, self.rng, self.sampling)
+        self.place_particles(y_init)
+
+    def place_particles(self, y_init):
+        """
+        Create the particles (or the batch engine) at x = 0 and the given heights.
+        """
+        self.particles = []
+        if self.engine in ("batch", "geometry", "event"):
+            args = (self.channel, np.zeros(self.n_particles), y_init, np.full(self.n_particles, self.Vx),
+                    np.full(self.n_particles, self.Vy), self.kernel, self.record)
+            if self.engine == "batch":
+                self.batch = BatchEngine(*args)
+            elif self.engine == "geometry":
+                self.batch = GeometryEngine(*args, max_bounces=self.max_bounces)
+            else:
+                self.batch = EventEngine(*args, max_bounces=self.max_bounces)
+            return
         for i in range(self.n_particles):
-            y_init = np.random.uniform(self.tol, self.channel.D - self.tol)
-            p = Particle(0, y_init, self.Vx, self.Vy)
+            p = Particle(0, y_init[i], self.Vx, self.Vy, self.record, i)
             self.particles.append(p)
     
+    def sample_angle(self, particle):
+        """
+        Draw the rebound angle of a particle from the scattering kernel.
+        """
+        theta_in = particle.specular_angle(self.channel) if self.kernel.needs_incidence else None
+        ids, steps = (np.array([particle.index]), np.array([particle.bounces])) if self.kernel.keyed else (None, None)
+        theta = self.kernel.sample(1, theta_in, ids, steps)[0]
+        particle.bounces += 1
+        return theta
+
     def simulate_particle(self, particle):
         """
         Run simulation for single particle.
         """
+        inst = self.instrumentation
+        if inst is not None:
+            inst.enter("first_flight")
         # Compute the distance to the conic section
         d1 = particle.distance_to_conic_section_x(self.channel)
         # Automatically particle left the channel
@@ -39,12 +103,16 @@ class Problem:
             particle.update_position(time)
             self.count += 1
             particle.out = True
+            if inst is not None:
+                inst.event(DIRECT_EXIT, particle.index)
         else:
             # Compute time taken to reach the conic section
             time = d1/particle.Vx
             particle.update_position(time)
             # Rebound with the conic section
-            theta = Diffuse.sample_angle()
+            if inst is not None:
+                inst.enter("output_check")
+            theta = self.sample_angle(particle)
             flag, gamma = particle.check_output_condition(self.channel, theta)
             if flag:
                 particle.update_velocity_after_rebound(self.channel, theta)
@@ -52,12 +120,19 @@ class Problem:
                 particle.update_position(dt)
                 self.count += 1
                 particle.out = True
+                if inst is not None:
+                    inst.event(EXIT, particle.index)
             else:
+                if inst is not None:
+                    inst.enter("conic_rebound")
                 while particle.check_rebound_condition_conic_section(self.channel, theta, gamma):
                     particle.update_velocity_after_rebound(self.channel, theta)
                     dt = particle.check_rebound_time_conic_section(self.channel)
                     particle.update_position(dt)
-                    theta = Diffuse.sample_angle()
+                    if inst is not None:
+                        inst.event(CONIC_REBOUND, particle.index)
+                        inst.enter("output_check")
+                    theta = self.sample_angle(particle)
                     flag, gamma = particle.check_output_condition(self.channel, theta)
                     if flag:
                         particle.update_velocity_after_rebound(self.channel, theta)
@@ -65,40 +140,166 @@ class Problem:
                         particle.update_position(dt)
                         self.count += 1
                         particle.out = True
+                        if inst is not None:
+                            inst.event(EXIT, particle.index)
                         break
+                    if inst is not None:
+                        inst.enter("conic_rebound")
                 
                 if not particle.out:
+                    if inst is not None:
+                        inst.enter("wall")
                     if particle.check_rebound_condition_low_plane(self.channel, theta):
                         particle.update_velocity_after_rebound(self.channel, theta)
                         dt = particle.check_rebound_time_low_plane()
                         particle.update_position(dt)
+                        wall = LOW_PLANE
                     elif particle.check_rebound_condition_up_plane(self.channel, theta):
                         particle.update_velocity_after_rebound(self.channel, theta)
                         dt = particle.check_rebound_time_up_plane(self.channel)
                         particle.update_position(dt)
+                        wall = UP_PLANE
                     else:
                         # Particle reaches the inlet
                         particle.update_velocity_after_rebound(self.channel, theta)
                         dt = particle.check_rebound_time_inlet()
                         particle.update_position(dt)
+                        wall = INLET
+                    if inst is not None:
+                        inst.event(wall, particle.index)
 
     
-    def run_simulation(self):
+    def run_simulation(self, verbose=True, checkpoint=None, checkpoint_interval=300.0):
         """
         Run the simulation for each particle.
+        If checkpoint is a file path, the state of the run is saved there every checkpoint_interval seconds
+        (between particles with the scalar engine, between rebound rounds with the batch engines) and the run
+        can be continued with resume.
         """
-        print("Running simulation with {} particles...".format(self.n_particles))
-        for particle in self.particles:
-            self.simulate_particle(particle)
-        print("Simulation finished.")
+        if verbose:
+            print("Running simulation with {} particles...".format(self.n_particles))
+        if checkpoint is not None:
+            self.run_checkpointed(checkpoint, checkpoint_interval)
+        elif self.instrumentation is not None:
+            self.run_instrumented()
+        elif self.batch is not None:
+            self.batch.run()
+            self.count = int(np.count_nonzero(self.batch.out))
+        else:
+            for particle in self.particles:
+                self.simulate_particle(particle)
+        if self.batch is not None:
+            self.n_capped = int(np.count_nonzero(self.batch.capped))
+        if verbose:
+            print("Simulation finished.")
     
+    def run_checkpointed(self, path, interval, position=None):
+        """
+        Run (or continue from position, see checkpoint.problem_state) saving the state to path every interval
+        seconds. The file is removed once the run finishes.
+        """
+        if self.engine == "event" or self.instrumentation is not None:
+            raise ValueError("Checkpoints are not available with the event engine or with instrumentation")
+        last = time.monotonic()
+        def save(position):
+            nonlocal last
+            if time.monotonic() - last >= interval:
+                save_checkpoint(path, *problem_state(self, position))
+                last = time.monotonic()
+
+        if self.batch is not None:
+            self.batch.run(position, save)
+            self.count = int(np.count_nonzero(self.batch.out))
+        else:
+            for i in range(0 if position is None else position, self.n_particles):
+                save(i)
+                self.simulate_particle(self.particles[i])
+        if os.path.exists(path):
+            os.remove(path)
+
+    def resume(self, path, verbose=True, checkpoint_interval=300.0):
+        """
+        Continue the run saved in the checkpoint path, bit-for-bit as if it had never stopped. The Problem must be
+        created with the same arguments as the interrupted one; distribute_initial_particles is not called.
+        """
+        position = restore_problem(self, *load_checkpoint(path))
+        if verbose:
+            print("Resuming simulation with {} particles...".format(self.n_particles))
+        self.run_checkpointed(path, checkpoint_interval, position)
+        if self.batch is not None:
+            self.n_capped = int(np.count_nonzero(self.batch.capped))
+        if verbose:
+            print("Simulation finished.")
+
+    def run_instrumented(self):
+        """
+        Same as run_simulation, feeding the instrumentation with the invalid floating point operations and the
+        bounce counts of the particles.
+        """
+        inst = self.instrumentation
+        with inst.capture_invalid():
+            if self.batch is not None:
+                self.batch.instrumentation = inst
+                self.batch.run()
+                self.count = int(np.count_nonzero(self.batch.out))
+                inst.finish(self.batch.bounces, self.batch.out)
+            else:
+                for particle in self.particles:
+                    self.simulate_particle(particle)
+                inst.finish([p.bounces for p in self.particles], [p.out for p in self.particles])
+        inst.enter(None)
+
+    def exit_stream(self, horizon=np.inf):
+        """
+        Time-ordered stream of (exit time, particle index) of the particles leaving the domain before the time
+        horizon. Only available with the event engine; a later call with a larger horizon resumes the simulation.
+        """
+        if self.engine != "event":
+            raise ValueError("The exit stream needs the event engine")
+        for t, i in self.batch.events(horizon):
+            self.count = len(self.batch.exits)
+            self.n_capped = self.batch.n_capped
+            yield t, i
+        self.n_capped = self.batch.n_capped
+
+    def exit_times(self):
+        """
+        Total time of flight of the particles that left the domain (in exit order with the event engine).
+        """
+        if self.engine == "event":
+            return self.batch.time[self.batch.exits]
+        if self.batch is not None:
+            return self.batch.time[self.batch.out]
+        return np.array([p.total_time for p in self.particles if p.out])
+
+    def particle_results(self):
+        """
+        Per-particle columns of the run: time of flight, final position, number of rebounds and whether the
+        particle left the domain.
+        """
+        if self.batch is not None:
+            b = self.batch
+            return {"time": b.time, "x": b.x, "y": b.y, "bounces": b.bounces, "out": b.out, "capped": b.capped}
+        ps = self.particles
+        return {"time": np.array([p.total_time for p in ps], dtype=float), "x": np.array([p.x for p in ps], dtype=float),
+                "y": np.array([p.y for p in ps], dtype=float), "bounces": np.array([p.bounces for p in ps], dtype=np.int64),
+                "out": np.array([p.out for p in ps], dtype=bool), "capped": np.zeros(len(ps), dtype=bool)}
+
+    def trajectories(self):
+        """
+        TrajectoryStore with the recorded trajectories, None if only the exit times are recorded.
+        """
+        if self.batch is not None:
+            return self.batch.trajectories()
+        if self.record == EXIT_TIME:
+            return None
+        return TrajectoryStore.from_particles(self.particles)
+
     def compute_particles_flow_rate_interarrival(self):
         """
         Compute the flow rate of particles leaving the domain using the interarriva time method.
         """
-        out_particles = [p for p in self.particles if p.out]
-        times_per_particle = [np.sum(p.time) for p in out_particles]
-        sorted_exit_times = np.sort(times_per_particle)
+        sorted_exit_times = np.sort(self.exit_times())
         inter_arrival_times = np.diff(sorted_exit_times)
         mean_interarrival = np.mean(inter_arrival_times)
         flow_rate = 1 / mean_interarrival
@@ -108,7 +309,5 @@ class Problem:
         """
         Compute the flow rate of particles leaving the domain using the maximum time method.
         """
-        out_particles = [p for p in self.particles if p.out]
-        times_per_particle = [np.sum(p.time) for p in out_particles]
-        return self.count/np.max(times_per_particle)
+        return self.count/np.max(self.exit_times())
     
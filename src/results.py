@@ -0,0 +1,146 @@
+import os
+import json
+import numpy as np
+from problem import Problem
+from estimator import FlowRateEstimator
+from trajectory import FULL, EXIT_TIME, TrajectoryStore
+
+# Per-particle columns of a result set
+COLUMNS = ("time", "x", "y", "bounces", "out")
+# Trajectory columns, only written when the segments are requested
+SEGMENTS = ("points", "velocities", "dt", "offsets")
+
+class ResultWriter:
+    def __init__(self, directory, channel, Vx, Vy, seed=None, kernel=None, segments=False):
+        """
+        Writes simulation results as columnar .npy files, one file per column and chunk of particles
+        (directory/<column>.<chunk>.npy), plus a meta.json header with the geometry, the seed and the chunk sizes.
+        The per-particle columns are the time of flight, the final position, the number of rebounds and the
+        out mask; the segments of the trajectories are added if segments is True.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory # Folder of the result set
+        self.segments = segments # Write the trajectory segments
+        self.meta = {"vertices": channel.vertices.tolist(), "kinds": channel.kinds, "names": channel.names,
+                     "Vx": Vx, "Vy": Vy, "seed": None if seed is None else str(seed),
+                     "kernel": "CosineKernel()" if kernel is None else repr(kernel),
+                     "columns": list(COLUMNS) + (list(SEGMENTS) if segments else []), "chunks": []}
+        if hasattr(channel, "l"):
+            self.meta["channel"] = {"l": channel.l, "L": channel.L, "d": channel.d, "D": channel.D}
+        self.write_meta()
+
+    def write_meta(self):
+        tmp = os.path.join(self.directory, "meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(tmp, os.path.join(self.directory, "meta.json"))
+
+    def add(self, columns, store=None):
+        """
+        Write a chunk: columns is a dict of per-particle arrays (as Problem.particle_results) and store the
+        TrajectoryStore of the chunk (needed when the segments are written).
+        """
+        chunk = len(self.meta["chunks"])
+        for name in COLUMNS:
+            np.save(os.path.join(self.directory, "{}.{:05d}.npy".format(name, chunk)), np.asarray(columns[name]))
+        if self.segments:
+            for name in SEGMENTS:
+                np.save(os.path.join(self.directory, "{}.{:05d}.npy".format(name, chunk)), getattr(store, name))
+        self.meta["chunks"].append(int(np.asarray(columns["out"]).size))
+        self.write_meta() # The header only lists complete chunks
+
+    def add_problem(self, problem):
+        self.add(problem.particle_results(), problem.trajectories() if self.segments else None)
+
+def simulate_to_disk(directory, channel, n_particles, Vx, Vy, seed=None, chunk_size=100000, tol=0.01, engine="batch",
+                     kernel=None, segments=False):
+    """
+    Simulate n_particles in chunks of chunk_size (child i of the SeedSequence for chunk i, as run_ensemble) and
+    write every chunk to the result set in directory as soon as it is done, so memory only holds one chunk.
+    Returns the ResultSet.
+    """
+    seed_seq = np.random.SeedSequence(seed)
+    writer = ResultWriter(directory, channel, Vx, Vy, seed_seq.entropy, kernel, segments)
+    n_chunks = -(-n_particles // chunk_size)
+    for i, child in enumerate(seed_seq.spawn(n_chunks)):
+        problem = Problem(channel, min(chunk_size, n_particles - i*chunk_size), Vx, Vy, tol=tol, engine=engine,
+                          rng=np.random.default_rng(child), kernel=kernel, record=FULL if segments else EXIT_TIME)
+        problem.distribute_initial_particles()
+        problem.run_simulation(verbose=False)
+        writer.add_problem(problem)
+    return ResultSet(directory)
+
+class ResultSet:
+    def __init__(self, directory):
+        """
+        Lazy view of a result set written by ResultWriter. Columns are memory-mapped chunk by chunk, so the
+        analyses below run on result sets larger than the memory.
+        """
+        self.directory = directory # Folder of the result set
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f) # Header of the result set
+        self.chunks = self.meta["chunks"] # Number of particles of each chunk
+        self.n_particles = sum(self.chunks) # Total number of particles
+
+    def __len__(self):
+        return self.n_particles
+
+    def load(self, name, chunk):
+        """
+        Memory-mapped column name of the given chunk.
+        """
+        return np.load(os.path.join(self.directory, "{}.{:05d}.npy".format(name, chunk)), mmap_mode="r")
+
+    def column(self, name):
+        """
+        Generator over the chunks of column name.
+        """
+        for chunk in range(len(self.chunks)):
+            yield self.load(name, chunk)
+
+    def exit_times(self):
+        """
+        Generator over the exit times of each chunk (only the particles that left the domain).
+        """
+        for chunk in range(len(self.chunks)):
+            yield np.asarray(self.load("time", chunk))[self.load("out", chunk)]
+
+    def trajectories(self, chunk):
+        """
+        TrajectoryStore of a chunk with memory-mapped arrays (only if the segments were written).
+        """
+        if "offsets" not in self.meta["columns"]:
+            raise ValueError("The result set has no trajectory segments")
+        return TrajectoryStore(*(self.load(name, chunk) for name in SEGMENTS), out=self.load("out", chunk))
+
+    def channel(self):
+        """
+        Geometry of the result set (a Channel if it was one).
+        """
+        from geometry import Geometry
+        from channel import Channel
+        if "channel" in self.meta:
+            c = self.meta["channel"]
+            return Channel(c["l"], c["L"], c["d"], c["D"])
+        return Geometry(self.meta["vertices"], self.meta["kinds"], self.meta["names"])
+
+    def estimator(self, confidence=0.95):
+        """
+        FlowRateEstimator fed with every chunk.
+        """
+        estimator = FlowRateEstimator(confidence)
+        for n, exit_times in zip(self.chunks, self.exit_times()):
+            estimator.update(exit_times, n)
+        return estimator
+
+    def compute_particles_flow_rate_interarrival(self):
+        """
+        Same metric as Problem.compute_particles_flow_rate_interarrival, computed chunk by chunk.
+        """
+        return self.estimator().compute_particles_flow_rate_interarrival()
+
+    def compute_particles_flow_max_time(self):
+        """
+        Same metric as Problem.compute_particles_flow_max_time, computed chunk by chunk.
+        """
+        return self.estimator().compute_particles_flow_max_time()
@@ -0,0 +1,65 @@
+import numpy as np
+
+# Sampling modes of the initial heights
+UNIFORM = "uniform" # Independent uniform heights
+STRATIFIED = "stratified" # One uniform height inside each of n equal strata
+SOBOL = "sobol" # Randomly shifted Sobol (van der Corput in base 2) sequence
+SAMPLINGS = (UNIFORM, STRATIFIED, SOBOL)
+
+def sample_heights(n, low, high, rng=np.random, sampling=UNIFORM):
+    """
+    n initial heights in [low, high]. Stratified and Sobol heights are still uniformly distributed (so the
+    estimators stay unbiased) but fill the interval far more evenly than independent draws.
+    """
+    if sampling == STRATIFIED:
+        u = (np.arange(n) + rng.random(n))/n
+    elif sampling == SOBOL:
+        u = sobol_1d(n, rng)
+    elif sampling == UNIFORM:
+        return rng.uniform(low, high, n)
+    else:
+        raise ValueError("Unknown sampling mode {}, use one of {}".format(sampling, SAMPLINGS))
+    return low + (high - low)*u
+
+def antithetic_heights(n, low, high, rng=np.random, sampling=UNIFORM):
+    """
+    n initial heights in [low, high] where particles 2k and 2k+1 are an antithetic pair. The channel is symmetric,
+    so what matters is the distance to the centre: the second particle of a pair is placed as far from the centre
+    as the first one is from the walls (y and D - y would behave exactly alike). Both are still uniform.
+    """
+    y = sample_heights(-(-n//2), low, high, rng, sampling)
+    centre, half = (low + high)/2, (high - low)/2
+    offset = y - centre
+    partner = centre + np.sign(offset)*(half - np.abs(offset))
+    return np.column_stack((y, partner)).ravel()[:n]
+
+def sobol_1d(n, rng=np.random):
+    """
+    First n points of the one dimensional Sobol sequence (the base 2 van der Corput sequence) with a random
+    digital shift, which keeps every point uniformly distributed.
+    """
+    i = np.arange(n, dtype=np.uint64) & np.uint64(0xFFFFFFFF)
+    # Reverse the 32 bits of the index
+    for shift, mask in ((1, 0x55555555), (2, 0x33333333), (4, 0x0F0F0F0F), (8, 0x00FF00FF), (16, 0x0000FFFF)):
+        s, m = np.uint64(shift), np.uint64(mask)
+        i = ((i >> s) & m) | ((i & m) << s)
+    i &= np.uint64(0xFFFFFFFF)
+    digital_shift = np.uint64(int(rng.random()*2**32))
+    return ((i ^ digital_shift).astype(float) + 0.5)/2**32
+
+def _mix(z):
+    # SplitMix64 finalizer
+    z = (z ^ (z >> np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+def hashed_uniforms(key, ids, steps, stream=0):
+    """
+    Counter-based uniform numbers in [0,1): the number only depends on (key, particle id, rebound number,
+    stream), not on the order in which the particles are simulated. Used for common random numbers.
+    """
+    with np.errstate(over='ignore'):
+        z = _mix(np.uint64(key) + np.asarray(ids).astype(np.uint64)*np.uint64(0x9E3779B97F4A7C15))
+        z = _mix(z + np.asarray(steps).astype(np.uint64)*np.uint64(0xD1B54A32D192ED03))
+        z = _mix(z + np.uint64(stream))
+    return (z >> np.uint64(11)).astype(float)*2.0**-53
@@ -0,0 +1,258 @@
+"""
+Local simulation job service. Run specs (the run configs of cli.py: geometry, particles, Vx, Vy, seed, engine,
+kernel...) are posted over HTTP, queued onto a process pool and answered from a shared cache. Identical
+in-flight requests share a single simulation.
+
+    python src/server.py --port 8765 --workers 4 --cache-mb 512
+
+    client = Client("http://127.0.0.1:8765")
+    future = client.submit({"geometry": {"d": 0.2}, "particles": 10**6, "seed": 1})
+    result = future.result() # or: result = await client.run(spec)
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import threading
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from cli import DEFAULTS, make_kernel, summarize
+
+def normalize_spec(spec):
+    """
+    Run spec with the defaults of cli.py filled in. Outputs and workers are decided by the server.
+    """
+    run = {k: (dict(v) if isinstance(v, dict) else v) for k, v in DEFAULTS.items() if k not in ("outputs", "workers")}
+    for key, value in spec.items():
+        if key in ("outputs", "workers"):
+            continue
+        if key not in run:
+            raise ValueError("Unknown run spec key {}".format(key))
+        if isinstance(value, dict):
+            run[key].update(value)
+        else:
+            run[key] = value
+    return run
+
+def spec_key(run):
+    # Identifier of a normalized run spec
+    return hashlib.sha1(json.dumps(run, sort_keys=True).encode()).hexdigest()
+
+def run_job(run):
+    """
+    Simulate a normalized run spec (in a pool worker) and return the encoded response.
+    """
+    from channel import Channel
+    from ensemble import run_ensemble
+    g = run["geometry"]
+    result = run_ensemble(Channel(g["l"], g["L"], g["d"], g["D"]), run["particles"], run["Vx"], run["Vy"],
+                          seed=run["seed"], n_workers=1, chunk_size=run["chunk_size"], tol=run["tol"],
+                          engine=run["engine"], kernel=make_kernel(run), sampling=run["sampling"])
+    buffer = io.BytesIO()
+    np.save(buffer, result.exit_times)
+    response = {"summary": summarize(run, result.exit_times, result.entropy, result.chunk_sizes, result.chunk_counts),
+                "exit_times": base64.b64encode(buffer.getvalue()).decode()}
+    return json.dumps(response).encode()
+
+class ResultCache:
+    def __init__(self, max_bytes):
+        """
+        Thread-safe cache of encoded responses. The least recently used entries are evicted once the total size
+        goes over max_bytes.
+        """
+        self.max_bytes = max_bytes # Size limit of the cache
+        self.entries = OrderedDict() # Encoded responses in least recently used order
+        self.size = 0 # Total size of the entries
+        self.hits = 0 # Requests answered from the cache
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            if len(value) > self.max_bytes:
+                return
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+class JobServer:
+    def __init__(self, host="127.0.0.1", port=8765, n_workers=None, max_cache_bytes=256*2**20):
+        """
+        HTTP job service on a process pool. POST /run with a JSON run spec answers with the summary and the exit
+        times of the run; GET /stats reports the cache and queue state. Port 0 picks a free port.
+        Specs without a seed are not reproducible, so they are neither cached nor deduplicated.
+        """
+        self.pool = ProcessPoolExecutor(max_workers=n_workers) # Simulation workers
+        self.cache = ResultCache(max_cache_bytes) # Shared cache of responses
+        self.inflight = {} # Futures of the runs being simulated, keyed by spec
+        self.deduplicated = 0 # Requests attached to an identical in-flight run
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), _handler(self))
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def submit(self, spec):
+        """
+        Future of the encoded response of a run spec: from the cache, shared with an identical in-flight run or
+        newly queued onto the pool.
+        """
+        run = normalize_spec(spec)
+        if run["seed"] is None:
+            return self.pool.submit(run_job, run)
+        key = spec_key(run)
+        cached = self.cache.get(key)
+        if cached is not None:
+            future = Future()
+            future.set_result(cached)
+            return future
+        with self.lock:
+            if key in self.inflight:
+                self.deduplicated += 1
+                return self.inflight[key]
+            future = self.pool.submit(run_job, run)
+            self.inflight[key] = future
+        future.add_done_callback(lambda f: self.finish(key, f))
+        return future
+
+    def finish(self, key, future):
+        if future.exception() is None:
+            self.cache.put(key, future.result())
+        with self.lock:
+            self.inflight.pop(key, None)
+
+    def stats(self):
+        return {"cache_entries": len(self.cache.entries), "cache_bytes": self.cache.size,
+                "cache_max_bytes": self.cache.max_bytes, "cache_hits": self.cache.hits,
+                "inflight": len(self.inflight), "deduplicated": self.deduplicated}
+
+    def start(self):
+        """
+        Serve from a background thread (for tests and notebooks). Returns the server.
+        """
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.pool.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+def _handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self.reply(200, json.dumps(server.stats()).encode())
+            else:
+                self.reply(404, b'{"error": "not found"}')
+
+        def do_POST(self):
+            if self.path != "/run":
+                self.reply(404, b'{"error": "not found"}')
+                return
+            try:
+                spec = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                body = server.submit(spec).result()
+            except (ValueError, TypeError, KeyError) as error:
+                self.reply(400, json.dumps({"error": str(error)}).encode())
+                return
+            except Exception as error:
+                self.reply(500, json.dumps({"error": repr(error)}).encode())
+                return
+            self.reply(200, body)
+
+        def log_message(self, format, *args):
+            pass
+    return Handler
+
+def decode_response(body):
+    """
+    Response dict with the exit times decoded to an array.
+    """
+    response = json.loads(body)
+    response["exit_times"] = np.load(io.BytesIO(base64.b64decode(response["exit_times"])))
+    return response
+
+class Client:
+    def __init__(self, url, max_requests=8):
+        """
+        Thin client of a JobServer. submit returns a concurrent.futures.Future and run is its asyncio version;
+        both resolve to a dict with the summary and the exit times of the run.
+        """
+        self.url = url.rstrip("/") # Address of the server
+        self.executor = ThreadPoolExecutor(max_workers=max_requests) # Threads waiting for the responses
+
+    def request(self, spec):
+        data = json.dumps(spec).encode()
+        request = urllib.request.Request(self.url + "/run", data=data, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as response:
+            return decode_response(response.read())
+
+    def submit(self, spec):
+        return self.executor.submit(self.request, spec)
+
+    async def run(self, spec):
+        return await asyncio.wrap_future(self.submit(spec))
+
+    def stats(self):
+        with urllib.request.urlopen(self.url + "/stats") as response:
+            return json.loads(response.read())
+
+    def close(self):
+        self.executor.shutdown()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local simulation job server")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--workers", type=int, help="Worker processes (one per CPU by default)")
+    parser.add_argument("--cache-mb", type=float, default=256, help="Size limit of the result cache in MB")
+    args = parser.parse_args(argv)
+    server = JobServer(args.host, args.port, args.workers, int(args.cache_mb*2**20))
+    print("Serving on {}".format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,139 @@
+import os
+import json
+import hashlib
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from channel import Channel
+from ensemble import simulate_chunk, EnsembleResult
+from estimator import FlowRateEstimator, needs_replicates
+from sampling import UNIFORM
+
+def chunk_seed(entropy, i):
+    # Same SeedSequence as the i-th child spawned by np.random.SeedSequence(entropy)
+    return np.random.SeedSequence(entropy, spawn_key=(i,))
+
+def kernel_name(kernel):
+    # The default kernel of Problem is the Knudsen cosine law
+    return "CosineKernel()" if kernel is None else repr(kernel)
+
+class SweepCache:
+    def __init__(self, directory):
+        """
+        On-disk cache of simulated geometries. Every entry is a .npz file with the exit times of each chunk
+        of particles, so a larger particle budget only has to simulate the missing chunks.
+        """
+        self.directory = directory # Folder holding the cache entries
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(channel, Vx, Vy, tol, engine, kernel, seed, chunk_size, sampling=UNIFORM):
+        """
+        Identifier of a simulation. The particle count is not part of it: it is stored inside the entry.
+        """
+        spec = {"l": channel.l, "L": channel.L, "d": channel.d, "D": channel.D, "Vx": Vx, "Vy": Vy, "tol": tol,
+                "engine": engine, "kernel": kernel_name(kernel), "seed": seed, "chunk_size": chunk_size}
+        if sampling != UNIFORM:
+            spec["sampling"] = sampling
+        return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key):
+        """
+        Return the list of (n_injected, exit_times) chunks stored for key, empty if it is not cached.
+        """
+        if not os.path.exists(self.path(key)):
+            return []
+        with np.load(self.path(key)) as data:
+            exit_times, sizes = data["exit_times"], data["chunk_sizes"] # Every access to data reads the file again
+            offsets = np.concatenate(([0], np.cumsum(data["chunk_counts"])))
+        return [(int(n), exit_times[offsets[i]:offsets[i+1]]) for i, n in enumerate(sizes)]
+
+    def save(self, key, chunks, meta):
+        # Write to a temporary file first so an interrupted sweep never leaves a corrupt entry
+        tmp = self.path(key) + ".tmp.npz"
+        np.savez(tmp, exit_times=np.concatenate([c[1] for c in chunks]),
+                 chunk_sizes=np.array([c[0] for c in chunks]), chunk_counts=np.array([c[1].size for c in chunks]),
+                 meta=json.dumps(meta))
+        os.replace(tmp, self.path(key))
+
+class SweepPoint:
+    def __init__(self, channel, result, estimator, n_cached, n_computed, chunk_flow_rates):
+        self.channel = channel # Channel object of the point
+        self.result = result # EnsembleResult with the exit times of the point
+        self.estimator = estimator # FlowRateEstimator with the flow rate and its confidence interval
+        self.n_cached = n_cached # Number of chunks read from the cache
+        self.n_computed = n_computed # Number of chunks simulated in this sweep
+        self.chunk_flow_rates = chunk_flow_rates # Flow rate per injected particle of each chunk (paired across points)
+
+def sweep(grid, n_particles, Vx, Vy, seed, cache_dir="sweep_cache", kernel=None, n_workers=None, chunk_size=100000,
+          tol=0.01, engine="batch", confidence=0.95, sampling=UNIFORM):
+    """
+    Simulate every combination of the l, L, d and D values of grid (a dict of lists) with n_particles each.
+    Cached chunks are reused and the missing ones of all the points are scheduled together over a process pool.
+    The seed must be given (an int) so that cached and new chunks come from the same SeedSequence.
+    """
+    points = list(itertools.product(*(np.atleast_1d(grid[name]).tolist() for name in ("l", "L", "d", "D"))))
+    return sweep_points(points, n_particles, Vx, Vy, seed, cache_dir, kernel, n_workers, chunk_size, tol, engine,
+                        confidence, sampling)
+
+def sweep_points(points, n_particles, Vx, Vy, seed, cache_dir="sweep_cache", kernel=None, n_workers=None,
+                 chunk_size=100000, tol=0.01, engine="batch", confidence=0.95, sampling=UNIFORM):
+    """
+    Same as sweep for a list of (l, L, d, D) tuples instead of a grid.
+    """
+    if isinstance(seed, (bool, np.bool_)) or not isinstance(seed, (int, np.integer)):
+        # Every chunk would get fresh entropy and the cache entries could never be reproduced
+        raise ValueError("A sweep needs an int seed, not {!r}".format(seed))
+    seed = int(seed)
+    cache = SweepCache(cache_dir)
+    n_chunks = -(-n_particles // chunk_size)
+    sizes = [min(chunk_size, n_particles - i*chunk_size) for i in range(n_chunks)]
+
+    # Reuse the cached chunks and collect the missing ones
+    channels, keys, stored, chunks, tasks = [], [], [], [], []
+    for p, params in enumerate(points):
+        channel = Channel(*params)
+        key = SweepCache.key(channel, Vx, Vy, tol, engine, kernel, seed, chunk_size, sampling)
+        cached = cache.load(key)
+        point_chunks = [None]*n_chunks
+        for i, size in enumerate(sizes):
+            if i < len(cached) and cached[i][0] == size:
+                point_chunks[i] = cached[i]
+            else:
+                tasks.append((p, i, (channel, size, Vx, Vy, tol, engine, kernel, chunk_seed(seed, i), sampling)))
+        channels.append(channel)
+        keys.append(key)
+        stored.append(cached)
+        chunks.append(point_chunks)
+
+    # Simulate the missing chunks of all the points
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    if n_workers == 1 or len(tasks) <= 1:
+        outputs = [simulate_chunk(*task[2]) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(tasks))) as pool:
+            outputs = list(pool.map(simulate_chunk, *zip(*[task[2] for task in tasks])))
+    n_computed = [0]*len(points)
+    for (p, i, args), exit_times in zip(tasks, outputs):
+        chunks[p][i] = (args[1], exit_times)
+        n_computed[p] += 1
+
+    results = []
+    for p, channel in enumerate(channels):
+        estimator = FlowRateEstimator(confidence, needs_replicates(sampling, kernel))
+        for size, exit_times in chunks[p]:
+            estimator.update(exit_times, size)
+        exit_times = np.concatenate([c[1] for c in chunks[p]])
+        if n_computed[p] and sum(c[0] for c in chunks[p]) > sum(c[0] for c in stored[p]):
+            meta = {"l": channel.l, "L": channel.L, "d": channel.d, "D": channel.D, "Vx": Vx, "Vy": Vy, "tol": tol,
+                    "engine": engine, "kernel": kernel_name(kernel), "sampling": sampling, "seed": seed, "n_particles": n_particles,
+                    "count": int(exit_times.size), "flow_rate": estimator.flow_rate(),
+                    "confidence_interval": list(estimator.confidence_interval())}
+            cache.save(keys[p], chunks[p], meta)
+        chunk_flow_rates = np.array([c[1].size/c[0]/np.mean(c[1]) if c[1].size else 0.0 for c in chunks[p]])
+        results.append(SweepPoint(channel, EnsembleResult(exit_times, n_particles, seed), estimator,
+                                  n_chunks - n_computed[p], n_computed[p], chunk_flow_rates))
+    return results
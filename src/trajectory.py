@@ -0,0 +1,74 @@
+import numpy as np
+
+# Recording levels of the particle trajectories
+FULL = "full" # Every rebound point, velocity and segment time
+ENDPOINTS = "endpoints" # Initial and final position, final velocity and total time
+EXIT_TIME = "exit_time" # Only the total time of flight, no trajectory is stored
+RECORD_LEVELS = (FULL, ENDPOINTS, EXIT_TIME)
+
+class TrajectoryStore:
+    def __init__(self, points, velocities, dt, offsets, out=None):
+        """
+        Trajectories of all the particles in contiguous arrays with CSR-style offsets.
+        The points of particle i are points[offsets[i]:offsets[i+1]] and its segments (velocity and time taken)
+        are velocities[s[i]:s[i+1]] and dt[s[i]:s[i+1]], with s = segment_offsets().
+        """
+        self.points = points # (M, 2) array of positions
+        self.velocities = velocities # (S, 2) array of velocities of each segment
+        self.dt = dt # (S,) array of time taken to follow each segment
+        self.offsets = offsets # (N+1,) array of point offsets of each particle
+        self.out = out # (N,) boolean array of the particles that left the domain (None if unknown)
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def segment_offsets(self):
+        # Every particle has one segment less than points
+        return self.offsets - np.arange(self.offsets.size)
+
+    def total_times(self):
+        """
+        Total time of flight of each particle (segment times summed in order, particle by particle).
+        """
+        s = self.segment_offsets()
+        return np.bincount(np.repeat(np.arange(len(self)), np.diff(s)), weights=self.dt, minlength=len(self))
+
+    def trayectory(self, i):
+        """
+        Points, velocities and segment times of particle i (views on the store arrays).
+        """
+        s = self.segment_offsets()
+        return (self.points[self.offsets[i]:self.offsets[i+1]], self.velocities[s[i]:s[i+1]], self.dt[s[i]:s[i+1]])
+
+    def slice(self, start, stop):
+        """
+        Store with the particles start to stop-1, sharing the arrays of this one.
+        """
+        s = self.segment_offsets()
+        out = None if self.out is None else self.out[start:stop]
+        return TrajectoryStore(self.points[self.offsets[start]:self.offsets[stop]], self.velocities[s[start]:s[stop]],
+                               self.dt[s[start]:s[stop]], self.offsets[start:stop + 1] - self.offsets[start], out)
+
+    @staticmethod
+    def from_segments(n_particles, point_ids, points, segment_ids, velocities, dt, out=None):
+        """
+        Build the store from unordered logs. Entries of the same particle must be given in chronological order.
+        """
+        order = np.argsort(point_ids, kind="stable")
+        seg_order = np.argsort(segment_ids, kind="stable")
+        offsets = np.zeros(n_particles + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(point_ids, minlength=n_particles))
+        return TrajectoryStore(points[order], velocities[seg_order], dt[seg_order], offsets, out)
+
+    @staticmethod
+    def from_particles(particles):
+        """
+        Build the store from the lists recorded by Particle objects.
+        """
+        counts = np.array([len(p.trayectory) for p in particles], dtype=np.int64)
+        offsets = np.zeros(counts.size + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        points = np.array([point for p in particles for point in p.trayectory], dtype=float).reshape(-1, 2)
+        velocities = np.array([v for p in particles for v in p.velocities[:len(p.time)]], dtype=float).reshape(-1, 2)
+        dt = np.array([t for p in particles for t in p.time], dtype=float)
+        return TrajectoryStore(points, velocities, dt, offsets, np.array([p.out for p in particles], dtype=bool))
@@ -0,0 +1,123 @@
+import numpy as np
+
+# Transfer matrices already built, keyed by geometry and discretization
+_cache = {}
+
+class TransferMatrix:
+    def __init__(self, channel, n_cells=200, n_gauss=4):
+        """
+        Deterministic solver of the diffuse (Knudsen cosine law) rebound process. Every rebounding wall is split in
+        n_cells cells and, since the fate of a particle after a rebound only depends on where it rebounded, the
+        process is a Markov chain over the cells. The probabilities of going from each cell to every other cell,
+        to the outlet and to the absorbing walls are the 2-D view factors between them. The matrices only depend
+        on the geometry, so they are built once and cached. The geometry must be convex (no wall hides another).
+        """
+        key = (channel.vertices.tobytes(), tuple(channel.kinds), n_cells, n_gauss)
+        if key not in _cache:
+            _cache[key] = TransferMatrix.build(channel, n_cells, n_gauss)
+        self.channel = channel # Geometry object
+        self.n_cells = n_cells # Number of cells of each rebounding wall
+        self.Q, self.Q_dist, self.r_out, self.r_out_dist, self.r_absorb = _cache[key]
+
+    @staticmethod
+    def build(channel, n_cells, n_gauss):
+        edges = np.roll(channel.edge, -1, axis=0)
+        turns = channel.edge[:, 0]*edges[:, 1] - channel.edge[:, 1]*edges[:, 0]
+        if not (np.all(turns >= 0) or np.all(turns <= 0)):
+            raise ValueError("The transfer-matrix solver needs a convex geometry")
+
+        # Source cells (midpoints) on the rebounding walls
+        walls = np.flatnonzero(channel.is_rebound)
+        frac = np.arange(n_cells + 1)/n_cells
+        cell_wall = np.repeat(walls, n_cells)
+        cell_a = (channel.start[walls, None, :] + frac[None, :-1, None]*channel.edge[walls, None, :]).reshape(-1, 2)
+        cell_b = (channel.start[walls, None, :] + frac[None, 1:, None]*channel.edge[walls, None, :]).reshape(-1, 2)
+        source = (cell_a + cell_b)/2
+        normal = channel.normal[cell_wall]
+
+        # Targets: the cells plus every non rebounding wall as a whole
+        others = np.flatnonzero(~channel.is_rebound)
+        target_wall = np.concatenate((cell_wall, others))
+        target_a = np.concatenate((cell_a, channel.start[others]))
+        target_b = np.concatenate((cell_b, channel.end[others]))
+
+        # Probability of reaching a target: (sin(theta_b) - sin(theta_a))/2, with theta measured from the normal
+        def sin_theta(points):
+            u = points[None, :, :] - source[:, None, :]
+            u /= np.linalg.norm(u, axis=2, keepdims=True)
+            return normal[:, None, 0]*u[..., 1] - normal[:, None, 1]*u[..., 0]
+        F = np.abs(sin_theta(target_b) - sin_theta(target_a))/2
+
+        # Mean distance travelled to each target (times its probability): integral of cos(theta)cos(phi)/2 ds
+        nodes, weights = np.polynomial.legendre.leggauss(n_gauss)
+        target_edge = target_b - target_a
+        target_length = np.linalg.norm(target_edge, axis=1)
+        target_normal = channel.normal[target_wall]
+        dist = np.zeros_like(F)
+        for node, weight in zip(nodes, weights):
+            u = target_a + (node + 1)/2*target_edge
+            u = u[None, :, :] - source[:, None, :]
+            u /= np.linalg.norm(u, axis=2, keepdims=True)
+            cos_theta = np.einsum('ik,ijk->ij', normal, u)
+            cos_phi = -np.einsum('jk,ijk->ij', target_normal, u)
+            dist += weight*target_length[None, :]/2*np.clip(cos_theta*cos_phi, 0, None)/2
+
+        # A cell does not see the cells of its own wall
+        same_wall = cell_wall[:, None] == target_wall[None, :]
+        F[same_wall] = 0
+        dist[same_wall] = 0
+
+        n = source.shape[0]
+        outlet = np.concatenate((np.zeros(n, dtype=bool), channel.is_outlet[others]))
+        absorb = ~outlet
+        absorb[:n] = False
+        return F[:, :n], dist[:, :n], F[:, outlet].sum(axis=1), dist[:, outlet].sum(axis=1), F[:, absorb].sum(axis=1)
+
+    def cell(self, wall, x, y):
+        """
+        Cell index of the points (x, y) lying on the given walls (-1 if the wall does not rebound).
+        """
+        channel = self.channel
+        rebound_walls = np.flatnonzero(channel.is_rebound)
+        rank = np.full(channel.length.size, -1)
+        rank[rebound_walls] = np.arange(rebound_walls.size)
+        s = ((x - channel.start[wall, 0])*channel.tangent[wall, 0] + (y - channel.start[wall, 1])*channel.tangent[wall, 1])
+        c = np.clip((s/channel.length[wall]*self.n_cells).astype(np.int64), 0, self.n_cells - 1)
+        return np.where(rank[wall] >= 0, rank[wall]*self.n_cells + c, -1)
+
+    def solve(self, Vx, Vy, tol=0.01, n_inject=100000):
+        """
+        Transmission probability and mean exit time of particles injected at x = 0 with y uniform in
+        [tol, D - tol] and velocity (Vx, Vy), as in Problem. The injection is integrated with n_inject
+        evenly spaced heights.
+        """
+        channel = self.channel
+        V = np.hypot(Vx, Vy)
+        A = np.eye(self.Q.shape[0]) - self.Q
+        h = np.linalg.solve(A, self.r_out) # Probability of leaving through the outlet from each cell
+        g = np.linalg.solve(A, (self.Q_dist @ h + self.r_out_dist)/V) # Expected exit time (times h) from each cell
+
+        # First flight of the injected particles
+        y = tol + (np.arange(n_inject) + 0.5)/n_inject*(channel.D - 2*tol)
+        x = np.zeros(n_inject)
+        inlet = channel.names.index("inlet")
+        wall, t = channel.cast(x, y, np.full(n_inject, Vx), np.full(n_inject, Vy), np.full(n_inject, inlet))
+        hit = wall >= 0
+        wall, t, x, y = wall[hit], t[hit], x[hit], y[hit]
+        cell = self.cell(wall, x + Vx*t, y + Vy*t)
+        direct = channel.is_outlet[wall]
+        on_cell = cell >= 0
+        p = (np.sum(direct) + np.sum(h[cell[on_cell]]))/n_inject
+        time = (np.sum(t[direct]) + np.sum(t[on_cell]*h[cell[on_cell]] + g[cell[on_cell]]))/n_inject
+        return TransferResult(p, time/p)
+
+class TransferResult:
+    def __init__(self, transmission_probability, mean_exit_time):
+        self.transmission_probability = transmission_probability # Probability of leaving through the outlet
+        self.mean_exit_time = mean_exit_time # Mean exit time of the particles that leave through the outlet
+
+    def flow_rate(self):
+        """
+        Flow rate per injected particle, same quantity as FlowRateEstimator.flow_rate.
+        """
+        return self.transmission_probability/self.mean_exit_time
@@ -1,7 +1,15 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation, PillowWriter
-from matplotlib.ticker import MultipleLocator
+
+# Plotting helpers, imported from plotting (and so matplotlib) only when they are first used
+_PLOTTING = ("visualize_simulation_single_particle", "visualize_simulation_all_particles", "StreamingGifWriter",
+             "export_simulation", "figure_features", "add_grid")
+__all__ = ["interpolate_trayectory", "segment_end_times", "interpolate_positions"] + list(_PLOTTING)
+
+def __getattr__(name):
+    if name in _PLOTTING:
+        import plotting
+        return getattr(plotting, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 def interpolate_trayectory(particle, dt_sim=0.25):
     """
@@ -24,156 +32,53 @@ def interpolate_trayectory(particle, dt_sim=0.25):
     traj = np.concatenate(traj_segments, axis=0) # Combine all segments into a single array
     return traj
  
-def visualize_simulation_single_particle(particle, channel, dt_sim=0.15):
-        """
-        Animate the trayectory of a single particle..
-        """
-       
-        smooth_traj = interpolate_trayectory(particle, dt_sim=dt_sim)
-        
-        # Use the channel's visualization method to get background figure
-        fig, ax = channel.visualize(False)
-        # Create a marker for the particle.
-        particle_marker, = ax.plot([], [], 'bo', markersize=8)
-        ax.legend()
-        
-        def init():
-            particle_marker.set_data([], [])
-            return (particle_marker,)
-        
-        def update(frame):
-            x, y = smooth_traj[frame, 1], smooth_traj[frame, 2]
-            particle_marker.set_data([x], [y])
-            return (particle_marker,)
-        
-        frames = range(len(smooth_traj))
-        ani = FuncAnimation(fig, update, frames=frames, init_func=init,
-                            blit=True)
-        # Save the animation as a GIF using PillowWriter.
-        # writer = PillowWriter() 
-        # ani.save("./images/simulation.gif", writer=writer)
-        plt.show()
-
-def visualize_simulation_all_particles(channel, particles):
+def segment_end_times(dt, s, seg_particle):
     """
-    Animate the movement of all particles over simulation time T.
-    Each particle has its trajectory stored in particle.trayectory and its segment durations in particle.time.
-    For particles that finish before T, we hold their final position constant.
+    End time of every segment measured from the start of its particle. The cumulative sums are done level by
+    level (first segments of all particles, then the second ones...) so they do not lose precision with the
+    number of particles.
     """
-    # Define uniform simulation time step.
-    T = max([np.sum(p.time) for p in particles]) # Maximum time taken by a particle to leave the domain.
-    dt_sim = T / 200  # Time step size for the animation.
-    num_frames = int(T / dt_sim)
-    
-    # Compute a smooth trajectory for each particle.
-    smooth_trajs = []
-    for p in particles:
-        traj = interpolate_trayectory(p, dt_sim=dt_sim)
-        smooth_trajs.append(traj)
-    
-    # Get figure and axis from the channel's visualization method.
-    fig, ax = channel.visualize(False)
-    
-    # Create a marker for each particle.
-    markers = []
-    for p in particles:
-        marker, = ax.plot([], [], 'bo', markersize=4)
-        markers.append(marker)
-    
-    def init():
-        for marker in markers:
-            marker.set_data([], [])
-        return markers
-    
-    def update(frame):
-        # For each particle, update its marker position.
-        for i, marker in enumerate(markers):
-            traj = smooth_trajs[i]
-            # If the particle's trajectory is shorter than the current frame, hold at its final position.
-            if frame < traj.shape[0]:
-                x, y = traj[frame, 1], traj[frame, 2]
-            else:
-                x, y = traj[-1, 1], traj[-1, 2]
-            marker.set_data([x], [y])
-        return markers
-    
-    ani = FuncAnimation(fig, update, frames=num_frames, init_func=init,
-                        blit=True)
-    
-    # # Optionally, save the animation as a GIF:
-    # writer = PillowWriter()
-    # ani.save("./images/all_particles_simulation.gif", writer=writer)
-    
-    plt.show()
-
+    t_end = dt.copy()
+    rank = np.arange(dt.size) - s[:-1][seg_particle] # Position of each segment inside its particle
+    order = np.argsort(rank, kind="stable")
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(rank)))) if dt.size > 0 else [0]
+    for lo, hi in zip(bounds[1:-1], bounds[2:]):
+        idx = order[lo:hi]
+        t_end[idx] += t_end[idx - 1]
+    return t_end
 
-# Function to make high quality plots    
-def figure_features(tex=True, font="serif", dpi=180):
-    """Customize figure settings.
-
-    Args:
-        tex (bool, optional): use LaTeX. Defaults to True.
-        font (str, optional): font type. Defaults to "serif".
-        dpi (int, optional): dots per inch. Defaults to 180.
+def interpolate_positions(store, times):
     """
-    plt.rcParams.update(
-        {
-            "font.size": 14,
-            "font.family": font,
-            "text.usetex": tex,
-            "figure.subplot.top": 0.9,
-            "figure.subplot.right": 0.9,
-            "figure.subplot.left": 0.15,
-            "figure.subplot.bottom": 0.15,
-            "figure.subplot.hspace": 0.2,
-            "savefig.dpi": dpi,
-            "savefig.format": "pdf",
-            "axes.titlesize": 11,
-            "axes.labelsize": 11,
-            "axes.axisbelow": True,
-            "xtick.direction": "in",
-            "ytick.direction": "in",
-            "xtick.major.size": 5,
-            "xtick.minor.size": 2.25,
-            "xtick.major.pad": 7.5,
-            "xtick.minor.pad": 7.5,
-            "ytick.major.pad": 7.5,
-            "ytick.minor.pad": 7.5,
-            "ytick.major.size": 5,
-            "ytick.minor.size": 2.25,
-            "xtick.labelsize": 11,
-            "ytick.labelsize": 11,
-            "legend.fontsize": 11,
-            "legend.framealpha": 1,
-            "figure.titlesize": 16,
-            "lines.linewidth": 2,
-        }
-    )
-
-
-def add_grid(ax, lines=True, locations=None):
-    """Add a grid to the current plot.
-
-    Args:
-        ax (Axis): axis object in which to draw the grid.
-        lines (bool, optional): add lines to the grid. Defaults to True.
-        locations (tuple, optional):
-            (xminor, xmajor, yminor, ymajor). Defaults to None.
+    Positions of all the particles of a TrajectoryStore at the given times, computed in one vectorized pass
+    (searchsorted over the cumulative segment times). Particles that already finished are held at their final
+    position. Returns an array of shape (len(times), number of particles, 2).
     """
-
-    if lines:
-        ax.grid(lines, alpha=0.5, which="minor", ls=":")
-        ax.grid(lines, alpha=0.7, which="major")
-
-    if locations is not None:
-
-        assert (
-            len(locations) == 4
-        ), "Invalid entry for the locations of the markers"
-
-        xmin, xmaj, ymin, ymaj = locations
-
-        ax.xaxis.set_minor_locator(MultipleLocator(xmin))
-        ax.xaxis.set_major_locator(MultipleLocator(xmaj))
-        ax.yaxis.set_minor_locator(MultipleLocator(ymin))
-        ax.yaxis.set_major_locator(MultipleLocator(ymaj))
+    times = np.atleast_1d(np.asarray(times, dtype=float))
+    n = len(store)
+    s = store.segment_offsets()
+    n_segments = np.diff(s)
+    seg_particle = np.repeat(np.arange(n), n_segments) # Particle of each segment
+    t_end = segment_end_times(store.dt, s, seg_particle) # End time of each segment, relative to its particle
+    totals = store.total_times()
+    # Shift every particle by a multiple of a period longer than any trajectory so the keys are globally sorted
+    period = 2*(totals.max() if n > 0 else 0) + 1
+    keys = seg_particle*period + t_end
+    t = np.clip(times[:, None], 0, totals[None, :])
+    seg = np.searchsorted(keys, t + np.arange(n)[None, :]*period, side='left')
+    first, last = s[:-1][None, :], np.maximum(s[1:] - 1, s[:-1])[None, :]
+    has_segments = (n_segments > 0)[None, :]
+    seg = np.where(has_segments, np.clip(seg, first, last), 0) # Stay inside the segments of each particle
+    if t_end.size > 0:
+        # The shifted keys are rounded: move to the neighbour segment if the rounding picked the wrong one
+        seg = np.where(has_segments & (seg < last) & (t > t_end[seg]), seg + 1, seg)
+        seg = np.where(has_segments & (seg > first) & (t <= t_end[np.maximum(seg - 1, 0)]), seg - 1, seg)
+    # Segment k of particle i goes from point k + i to point k + i + 1
+    start = store.points[np.where(has_segments, seg + np.arange(n)[None, :], store.offsets[:-1][None, :])]
+    if store.dt.size == 0:
+        return start
+    end = store.points[np.where(has_segments, seg + np.arange(n)[None, :] + 1, store.offsets[:-1][None, :])]
+    dt = store.dt[seg]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(dt > 0, 1 - (t_end[seg] - t)/dt, 1.0)
+    frac = np.where(has_segments, frac, 0.0)
+    return start + frac[..., None]*(end - start)
@@ -0,0 +1,66 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from channel import Channel
+from diffuse import CosineKernel, MaxwellKernel
+from ensemble import simulate_chunk
+from problem import Problem
+from sampling import antithetic_heights
+
+def estimates(kernel, engine, n_particles, seed):
+    """
+    Transmission probability and mean exit time with their standard errors. The errors are computed over the
+    pairs of particles 2k and 2k+1, which are independent with and without antithetic numbers.
+    """
+    problem = Problem(Channel(0.2, 1.0, 0.05, 0.5), n_particles, 1, 0, engine=engine,
+                      rng=np.random.default_rng(seed), kernel=kernel, record="exit_time")
+    problem.distribute_initial_particles()
+    problem.run_simulation(verbose=False)
+    results = problem.particle_results()
+    out = results["out"].reshape(-1, 2).sum(axis=1)
+    time = np.where(results["out"], results["time"], 0.0).reshape(-1, 2).sum(axis=1)
+    n = out.size
+    p, p_se = out.mean()/2, out.std(ddof=1)/2/np.sqrt(n)
+    tau = time.sum()/out.sum()
+    tau_se = (time - tau*out).std(ddof=1)/out.mean()/np.sqrt(n) # Delta method for the ratio
+    return np.array([p, tau]), np.array([p_se, tau_se])
+
+@pytest.mark.parametrize("engine, n_particles", [("scalar", 4000), ("batch", 20000), ("geometry", 20000)])
+@pytest.mark.parametrize("kernel", [CosineKernel, lambda **kwargs: MaxwellKernel(0.5, **kwargs)])
+def test_antithetic_matches_plain_sampling(kernel, engine, n_particles):
+    plain, plain_se = estimates(kernel(), engine, n_particles, 1)
+    antithetic, antithetic_se = estimates(kernel(antithetic=True), engine, n_particles, 2)
+    assert np.all(np.abs(plain - antithetic) < 1.96*(plain_se + antithetic_se))
+
+def test_antithetic_pairs_particles():
+    kernel = CosineKernel(antithetic=True).with_rng(np.random.default_rng(0))
+    ids, steps = np.arange(8), np.zeros(8, dtype=np.int64)
+    u = kernel.uniforms(8, ids, steps)
+    assert np.allclose(u[0::2] + u[1::2], 1)
+    # The rebounds of one particle are not paired with each other
+    v = kernel.uniforms(8, ids, steps + 1)
+    assert not np.allclose(u + v, 1)
+    with pytest.raises(ValueError):
+        kernel.uniforms(8)
+
+def test_antithetic_heights_are_uniform_pairs():
+    y = antithetic_heights(200001, 0.01, 0.49, np.random.default_rng(0))
+    assert y.size == 200001 and y.min() >= 0.01 and y.max() <= 0.49
+    # The two particles of a pair are as far from the centre as the other one is from the walls
+    offsets = np.abs(y[:-1].reshape(-1, 2) - 0.25)
+    assert np.allclose(offsets.sum(axis=1), 0.24)
+    assert np.allclose(np.histogram(y, bins=12, range=(0.01, 0.49))[0]/y.size, 1/12, atol=0.005)
+
+def test_antithetic_sampling_reduces_the_variance():
+    # Spread of the flow rate of independent chunks with and without antithetic pairs
+    channel, children = Channel(0.7, 1, 0.15, 0.5), np.random.SeedSequence(11).spawn(200)
+    spread = []
+    for kernel in (None, CosineKernel(antithetic=True)):
+        q = [e.size/1000/np.mean(e) for e in (simulate_chunk(channel, 1000, 1, 0, 0.01, "batch", kernel, child)
+                                              for child in children)]
+        spread.append(np.std(q, ddof=1))
+    assert spread[1] < 0.85*spread[0]